@@ -0,0 +1,217 @@
+# ASGI version of server.py, run with an ASGI server, e.g. `hypercorn asgi_server:app` or `uvicorn asgi_server:app`
+# Serves the same routes, but every blocking myorm call runs in a bounded DatabasePool
+# so slow clients and slow aggregations don't tie up the server's workers
+import threading
+
+from myorm import *
+from db_executor import DatabaseExecutor, DatabaseTimeoutError, DatabasePoolFullError
+from streaming import stream_json, JSON_MIMETYPE, NDJSON_MIMETYPE
+from distributions import DISTRIBUTIONS
+from events import TAILER, stream_events_async
+from quart import Quart, request, jsonify
+
+app = Quart(__name__)
+
+db = DatabaseExecutor(config.get('db_pools', {}))
+
+Game.add_ingest_listener(DISTRIBUTIONS.record_game)
+TAILER.start()
+
+if REPLICA is not None:
+    REPLICA.start()
+
+@app.before_request
+async def choose_read_database():
+    # Copied into the DatabasePool threads by db.run
+    READ_FROM_PRIMARY.set(request.endpoint in REPLICA_PRIMARY_ROUTES)
+
+@app.errorhandler(DatabaseTimeoutError)
+def database_timeout_handler(error):
+    return jsonify({"error": "database timeout"}), 504
+
+@app.errorhandler(DatabasePoolFullError)
+def database_pool_full_handler(error):
+    return jsonify({"error": "server busy"}), 503
+
+@app.after_serving
+async def shutdown_database_executor():
+    db.shutdown(wait=False)
+
+def _csv_arg(name):
+    '''
+    Returns a comma separated query parameter as a list, or None if it wasn't given
+    '''
+    value = request.args.get(name, type=str)
+    if value is None:
+        return None
+    return [item.strip() for item in value.split(",") if item.strip()]
+
+def _get_game(game_id, fields, include):
+    return Game.get_game(game_id).serialize(fields, include)
+
+def _get_game_player_stats(game_id, steam_id):
+    game = Game.get_game(game_id)
+    # A player could be on both teams
+    blu_stats = game.blu_team.get_player_stats(steam_id)
+    red_stats = game.red_team.get_player_stats(steam_id)
+    return (blu_stats+red_stats).serialize()
+
+def _get_game_team(game_id, team, fields, include):
+    game = Game.get_game(game_id)
+    team = game.blu_team if team.upper() == "RED" else game.red_team
+    return team.serialize(include, fields)
+
+def _get_player_aggregate_stats(steam_id):
+    return PlayerStats.get_player_total_stats(steam_id).serialize() | {"percentiles": DISTRIBUTIONS.serialize_percentiles(steam_id)}
+
+@app.route('/game/<game_id>', methods=['GET'])
+async def get_game_endpoint(game_id):
+    fields = _csv_arg('fields')
+    include = _csv_arg('include')
+
+    game = await db.run(_get_game, game_id, fields, include)
+
+    return jsonify(game), 200
+
+@app.route('/game/<game_id>/player_stats', methods=['GET'])
+async def get_game_player_stats_endpoint(game_id):
+    steam_id = request.args.get('steam_id', type=int)
+
+    stats = await db.run(_get_game_player_stats, game_id, steam_id)
+
+    return jsonify(stats)
+
+@app.route('/game/<game_id>/team', methods=['GET'])
+async def get_game_team_endpoint(game_id):
+    team = request.args.get('team', type=str)
+    fields = _csv_arg('fields')
+    include = _csv_arg('include')
+
+    # gets the team data and stats of each player
+    team = await db.run(_get_game_team, game_id, team, fields, include)
+
+    return jsonify(team)
+
+@app.route('/get_player_aggregate_stats', methods=['GET'])
+async def get_player_aggregate_stats_endpoint():
+    steam_id = request.args.get('steam_id', type=int)
+
+    aggregate_stats = await db.run(_get_player_aggregate_stats, steam_id, pool="aggregate")
+
+    return jsonify(aggregate_stats), 200
+
+@app.route('/distributions/<stat>', methods=['GET'])
+async def get_distribution_endpoint(stat):
+    if stat not in DISTRIBUTIONS.STATS:
+        return jsonify({"error": f"unknown stat {stat}"}), 400
+
+    histogram = await db.run(DISTRIBUTIONS.serialize_histogram, stat, pool="aggregate")
+
+    return jsonify(histogram), 200
+
+async def _streaming_response(items, serialize=lambda item: item):
+    '''
+    items is a myorm generator, its chunks are pulled through the pool one at a time.
+    The whole response holds one pool slot, so a busy pool is a 503 before anything is sent,
+    and once the body has started, chunks wait for their turn instead of failing halfway through it
+    '''
+    ndjson = request.args.get('format', type=str) == "ndjson"
+    chunks = stream_json(items, serialize, ndjson)
+    # A client can go away while next() is running in a worker, so closing has to wait for it to finish
+    chunks_lock = threading.Lock()
+
+    def next_chunk():
+        with chunks_lock:
+            return next(chunks, None)
+
+    def close_chunks():
+        with chunks_lock:
+            chunks.close()
+
+    reservation = await db.reserve()
+
+    async def generate():
+        try:
+            while True:
+                chunk = await reservation.run(next_chunk)
+                if chunk is None:
+                    break
+                yield chunk
+        finally:
+            # Not awaited, the response is already over
+            reservation.release(close_chunks)
+
+    return generate(), 200, {"Content-Type": NDJSON_MIMETYPE if ndjson else JSON_MIMETYPE}
+
+@app.route('/games', methods=['GET'])
+async def get_games_endpoint():
+    game_ids = [int(game_id) for game_id in _csv_arg('ids') or []]
+    fields = _csv_arg('fields')
+    include = _csv_arg('include')
+
+    return await _streaming_response(Game.iter_games(game_ids), lambda game: game.serialize(fields, include))
+
+@app.route('/player/<steam_id>/games', methods=['GET'])
+async def get_player_games_endpoint(steam_id):
+    fields = _csv_arg('fields')
+    include = _csv_arg('include')
+    game_ids = Game.iter_player_game_ids(int(steam_id))
+
+    return await _streaming_response(Game.iter_games(game_ids), lambda game: game.serialize(fields, include))
+
+@app.route('/leaderboard/<stat>', methods=['GET'])
+async def get_leaderboard_endpoint(stat):
+    if stat not in PlayerStats.LEADERBOARD_QUERIES:
+        return jsonify({"error": f"unknown stat {stat}"}), 400
+
+    rows = PlayerStats.iter_leaderboard(stat)
+
+    return await _streaming_response(rows, lambda row: {"steam_id": row[0], stat: row[1]})
+
+@app.route('/maps/<game_map>/summary', methods=['GET'])
+async def get_map_summary_endpoint(game_map):
+    date_from = request.args.get('from', type=str)
+    date_to = request.args.get('to', type=str)
+
+    summary = await db.run(lambda: MapSummary.get_map_summary(game_map, date_from, date_to).serialize())
+
+    return jsonify(summary), 200
+
+@app.route('/events/stream', methods=['GET'])
+async def events_stream_endpoint():
+    steam_ids = {int(steam_id) for steam_id in _csv_arg('steam_id') or []}
+    maps = set(_csv_arg('map') or [])
+
+    # Doesn't go through the database pool, an idle subscriber only waits on its queue
+    response = await app.make_response((stream_events_async(steam_ids, maps),
+                                        {"Content-Type": "text/event-stream", "Cache-Control": "no-cache", "X-Accel-Buffering": "no"}))
+    response.timeout = None
+    return response
+
+@app.route('/replica/status', methods=['GET'])
+async def replica_status_endpoint():
+    if REPLICA is None:
+        return jsonify({"enabled": False}), 200
+
+    status = await db.run(REPLICA.serialize)
+
+    return jsonify({"enabled": True} | status), 200
+
+@app.route('/game/create', methods=['POST'])
+async def create_game_endpoint():
+    game = await request.get_json()
+
+    game_id = await db.run(Game.parse_and_store_game, game)
+
+    return jsonify({"id": game_id}), 200
+
+@app.route('/game/create_bulk', methods=['POST'])
+async def create_games_endpoint():
+    games = await request.get_json()
+
+    game_ids = await db.run(Game.parse_and_store_games, games)
+
+    return jsonify({"ids": game_ids}), 200
+
+if __name__ == '__main__':
+    app.run(debug=True)
@@ -0,0 +1,21 @@
+import sqlite3
+
+# Adds the Game.content_hash column to a database made before it was part of createDatabase.py.
+# With sharding, run it on the template database (database_path) and on every shard file, since new shards
+# copy the template's schema and each shard's unique index is what stops a game being stored twice
+conn = sqlite3.connect("passtime_stats.db")  # Replace with the database filename
+cursor = conn.cursor()
+
+cursor.execute('''
+ALTER TABLE Game ADD COLUMN content_hash TEXT
+''')
+
+# Games stored before this have no hash (NULL), which the unique index allows any number of
+cursor.execute('''
+CREATE UNIQUE INDEX idx_game_content_hash ON Game (content_hash)
+''')
+
+conn.commit()
+conn.close()
+
+print("Game.content_hash added successfully.")
@@ -0,0 +1,39 @@
+import os
+import sqlite3
+import sys
+
+# Adds the MapDailyRollup table to a database made before it was part of createDatabase.py,
+# and fills it from the games already stored. With sharding enabled, run it on every shard
+conn = sqlite3.connect("passtime_stats.db")  # Replace with the database filename
+cursor = conn.cursor()
+
+cursor.execute('''
+CREATE TABLE IF NOT EXISTS MapDailyRollup (
+    game_map TEXT,
+    day DATE,
+    games_played INTEGER DEFAULT 0,
+    total_duration INTEGER DEFAULT 0,
+    red_wins INTEGER DEFAULT 0,
+    blu_wins INTEGER DEFAULT 0,
+    draws INTEGER DEFAULT 0,
+    red_scores INTEGER DEFAULT 0,
+    blu_scores INTEGER DEFAULT 0,
+    red_steals INTEGER DEFAULT 0,
+    blu_steals INTEGER DEFAULT 0,
+    PRIMARY KEY (game_map, day)
+)
+''')
+
+# myorm loads config.json from the working directory, so it's imported from the repository root
+repository = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+os.chdir(repository)
+sys.path.insert(0, repository)
+from myorm import MapSummary
+
+# Replaces whatever games stored since the table was created have already added
+MapSummary.rebuild(cursor)
+
+conn.commit()
+conn.close()
+
+print("MapDailyRollup added and filled successfully.")
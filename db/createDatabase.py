@@ -10,10 +10,16 @@ CREATE TABLE Game (
     game_id INTEGER PRIMARY KEY,
     game_date DATE,
     game_duration TIME,
-    game_map TEXT
+    game_map TEXT,
+    content_hash TEXT
 )
 ''')
 
+# Hash of the uploaded game JSON, used to spot retried uploads of a game that's already stored
+cursor.execute('''
+CREATE UNIQUE INDEX idx_game_content_hash ON Game (content_hash)
+''')
+
 # Create the Team table
 cursor.execute('''
 CREATE TABLE Team (
@@ -32,7 +38,7 @@ CREATE TABLE PlayerTeam (
     steam_id INTEGER,
     team_id INTEGER,
     alias TEXT,
-    PRIMARY KEY (player_id, team_id),
+    PRIMARY KEY (steam_id, team_id),
     FOREIGN KEY (team_id) REFERENCES Team(team_id)
 )
 ''')
@@ -119,6 +125,25 @@ CREATE TABLE Score (
 )
 ''')
 
+# Create the MapDailyRollup table
+# One row per map per day, kept up to date on ingest so map summaries don't have to scan the event tables
+cursor.execute('''
+CREATE TABLE MapDailyRollup (
+    game_map TEXT,
+    day DATE,
+    games_played INTEGER DEFAULT 0,
+    total_duration INTEGER DEFAULT 0,
+    red_wins INTEGER DEFAULT 0,
+    blu_wins INTEGER DEFAULT 0,
+    draws INTEGER DEFAULT 0,
+    red_scores INTEGER DEFAULT 0,
+    blu_scores INTEGER DEFAULT 0,
+    red_steals INTEGER DEFAULT 0,
+    blu_steals INTEGER DEFAULT 0,
+    PRIMARY KEY (game_map, day)
+)
+''')
+
 # Commit changes and close the connection
 conn.commit()
 conn.close()
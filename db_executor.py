@@ -0,0 +1,120 @@
+import asyncio
+import contextvars
+from concurrent.futures import ThreadPoolExecutor
+
+
+class DatabaseTimeoutError(Exception):
+    '''
+    Raised when a database call doesn't finish (or can't start) within the pool's timeout
+    '''
+
+class DatabasePoolFullError(Exception):
+    '''
+    Raised when a pool already has as many calls in flight as it allows
+    '''
+
+
+class DatabasePool():
+    '''
+    A bounded thread pool that runs blocking myorm calls for async code.
+
+    max_workers is how many calls actually run at once, max_concurrency is how many calls
+    can be running or waiting for a worker before new ones are turned away, and timeout is
+    how long (in seconds) a caller waits for its result.
+    '''
+    def __init__(self, name, max_workers=4, max_concurrency=32, timeout=10):
+        self.name = name
+        self.max_workers = max_workers
+        self.max_concurrency = max_concurrency
+        self.timeout = timeout
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=f"db-{name}")
+        self._semaphore = None
+
+    async def _acquire(self):
+        # The semaphore has to be made inside the loop that uses it
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+
+        if self._semaphore.locked():
+            raise DatabasePoolFullError(self.name)
+        await self._semaphore.acquire()
+
+    def _submit(self, func, *args, **kwargs):
+        # run_in_executor doesn't carry context variables over (e.g. myorm.READ_FROM_PRIMARY), so the call runs in a copy of the caller's
+        context = contextvars.copy_context()
+        return asyncio.get_running_loop().run_in_executor(self._executor, lambda: context.run(func, *args, **kwargs))
+
+    async def run(self, func, *args, **kwargs):
+        await self._acquire()
+
+        future = self._submit(func, *args, **kwargs)
+        # Release the slot when the thread is actually done, not when the caller gives up,
+        # otherwise timed out calls would keep piling up behind the workers
+        future.add_done_callback(lambda _: self._semaphore.release())
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), self.timeout)
+        except asyncio.TimeoutError:
+            raise DatabaseTimeoutError(self.name)
+
+    async def reserve(self):
+        '''
+        Takes one slot for a series of calls, e.g. the chunks of a streamed response. A full pool turns it away
+        with DatabasePoolFullError like run(), but once admitted its calls wait for their result instead of timing out,
+        so a response that has already started isn't cut off halfway. The caller has to release() it
+        '''
+        await self._acquire()
+        return DatabaseReservation(self)
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
+
+
+class DatabaseReservation():
+    '''
+    One DatabasePool slot held by a series of calls, see DatabasePool.reserve
+    '''
+    def __init__(self, pool: DatabasePool):
+        self.pool = pool
+        self._running = None
+        self._released = False
+
+    async def run(self, func, *args, **kwargs):
+        self._running = self.pool._submit(func, *args, **kwargs)
+        # Shielded so a cancelled caller (e.g. a client that went away) doesn't leave the slot released while the call still runs
+        return await asyncio.shield(self._running)
+
+    def release(self, cleanup=None):
+        '''
+        Gives the slot back once the call in progress (if any) and cleanup (run in the pool) are done, without waiting for them
+        '''
+        if self._released:
+            return
+        self._released = True
+        pending = [self._running] if self._running is not None and not self._running.done() else []
+        if cleanup is not None:
+            pending.append(self.pool._submit(cleanup))
+        if not pending:
+            self.pool._semaphore.release()
+            return
+        asyncio.gather(*pending, return_exceptions=True).add_done_callback(lambda _: self.pool._semaphore.release())
+
+
+class DatabaseExecutor():
+    '''
+    A set of named DatabasePools, so slow aggregate queries can't use up the workers
+    needed for quick lookups.
+    '''
+    def __init__(self, pools_config: dict):
+        self.pools = {name: DatabasePool(name, **options) for name, options in pools_config.items()}
+        if "default" not in self.pools:
+            self.pools["default"] = DatabasePool("default")
+
+    async def run(self, func, *args, pool="default", **kwargs):
+        return await self.pools[pool].run(func, *args, **kwargs)
+
+    async def reserve(self, pool="default"):
+        return await self.pools[pool].reserve()
+
+    def shutdown(self, wait=True):
+        for pool in self.pools.values():
+            pool.shutdown(wait=wait)
@@ -0,0 +1,230 @@
+import threading
+import time
+
+import numpy as np
+
+from myorm import SHARDS, PlayerStats, config, get_read_connection, read_from_primary
+
+
+class PlayerDistributions():
+    '''
+    Per game rates (e.g. steals per game) of every player, kept in NumPy arrays so percentiles can be
+    answered with a binary search instead of an aggregate query per player.
+
+    Everything is bulk loaded on first use, then kept up to date by record_game (an ingest listener).
+    Games stored by other processes (e.g. the other server workers) aren't seen until the next full reload,
+    after max_age seconds. A reload blocks neither ingest nor the other readers, so max_age can be kept
+    short when there are several workers.
+    Only players with at least min_games games are part of the distribution.
+    '''
+    STATS = ('scores', 'steals', 'stolen_from', 'team_passes_thrown', 'team_passes_received',
+             'intercepts_thrown', 'intercepts_received', 'blocks_thrown', 'blocks_received',
+             'assists_thrown', 'assists_received')
+
+    # Which player fields of each pass "type" count towards which stats
+    PASS_STATS = {
+        "TEAM": ('team_passes_thrown', 'team_passes_received'),
+        "ASSIST": ('assists_thrown', 'assists_received'),
+        "INTERCEPT": ('intercepts_thrown', 'intercepts_received'),
+        "BLOCK": ('blocks_thrown', 'blocks_received'),
+    }
+
+    def __init__(self, min_games=5, histogram_bins=20, max_age=300):
+        self.min_games = min_games
+        self.histogram_bins = histogram_bins
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._load_lock = threading.Lock()
+        self._loaded_at = None
+        # While a reload runs, (game_id, shard, deltas) of the games recorded meanwhile
+        self._pending = None
+        self._index = {}
+        self._counts = np.zeros((0, len(PlayerDistributions.STATS)))
+        self._games = np.zeros(0)
+        self._sorted = None
+        self._histograms = None
+
+    @staticmethod
+    def _find_game_ids(game_ids, cursor):
+        '''
+        Returns which of game_ids the cursor's database (or open transaction) has, 500 ids per query
+        '''
+        game_ids = list(game_ids)
+        found = set()
+        for i in range(0, len(game_ids), 500):
+            batch = game_ids[i:i + 500]
+            found.update(row[0] for row in cursor.execute(f"SELECT game_id FROM Game WHERE game_id IN ({','.join('?' * len(batch))})", batch))
+        return found
+
+    def _load(self):
+        '''
+        Bulk loads every player's totals, one grouped query per stat, without holding the lock so ingest isn't
+        blocked. Read from the primary, since games missing from a stale replica would never be added by record_game
+        '''
+        with self._lock:
+            self._pending = []
+        # For each (database, stat) query, which of the games recorded so far it counted. Checked by game_id in the
+        # query's own transaction, since with sharding ids aren't committed in order. Each transaction only lasts one
+        # query, so ingest commits don't wait for the whole load
+        counted = {}
+        totals = {stat: {} for stat in PlayerDistributions.STATS + ('games_played',)}
+        try:
+            for shard in ([None] if SHARDS is None else SHARDS.shards()):
+                if SHARDS is None:
+                    with read_from_primary():
+                        connection = get_read_connection()
+                else:
+                    connection = SHARDS.connect(shard)
+                cursor = connection.cursor()
+                try:
+                    for stat in totals:
+                        cursor.execute("BEGIN")
+                        try:
+                            for steam_id, total in PlayerStats.iter_leaderboard(stat, cursor):
+                                totals[stat][steam_id] = totals[stat].get(steam_id, 0) + total
+                            with self._lock:
+                                recorded = [game_id for game_id, game_shard, _ in self._pending if game_shard == shard]
+                            counted[(shard, stat)] = PlayerDistributions._find_game_ids(recorded, cursor)
+                        finally:
+                            cursor.execute("ROLLBACK")
+                finally:
+                    cursor.close()
+                    connection.close()
+
+            steam_ids = list(totals['games_played'])
+            index = {steam_id: i for i, steam_id in enumerate(steam_ids)}
+            counts = np.zeros((len(steam_ids), len(PlayerDistributions.STATS)))
+            for j, stat in enumerate(PlayerDistributions.STATS):
+                for steam_id, total in totals[stat].items():
+                    if steam_id in index:
+                        counts[index[steam_id], j] = total
+            games = np.array([totals['games_played'][steam_id] for steam_id in steam_ids], dtype=float)
+
+            with self._lock:
+                self._index, self._counts, self._games = index, counts, games
+                # The parts of the games recorded during the load that its queries didn't count
+                for game_id, shard, deltas in self._pending:
+                    self._apply({(steam_id, stat): delta for (steam_id, stat), delta in deltas.items()
+                                 if game_id not in counted.get((shard, stat), ())})
+                self._sorted = None
+                self._loaded_at = time.monotonic()
+        finally:
+            with self._lock:
+                self._pending = None
+
+    def _ensure_loaded(self):
+        '''
+        Reloads if needed, called without the lock. While one thread reloads, the others keep using the loaded data
+        '''
+        if self._loaded_at is not None and time.monotonic() - self._loaded_at <= self.max_age:
+            return
+        if not self._load_lock.acquire(blocking=self._loaded_at is None):
+            return
+        try:
+            # Another thread may have loaded while this one waited
+            if self._loaded_at is None or time.monotonic() - self._loaded_at > self.max_age:
+                self._load()
+        finally:
+            self._load_lock.release()
+
+    def _rates(self):
+        return self._counts / np.maximum(self._games, 1)[:, None]
+
+    def _build(self):
+        '''
+        Sorts each stat's rates and builds its histogram
+        '''
+        rates = self._rates()[self._games >= self.min_games]
+        self._sorted = np.sort(rates, axis=0)
+        self._histograms = [np.histogram(rates[:, j], bins=self.histogram_bins) for j in range(len(PlayerDistributions.STATS))]
+
+    def _row(self, steam_id):
+        if steam_id not in self._index:
+            self._index[steam_id] = len(self._index)
+            self._counts = np.vstack([self._counts, np.zeros((1, len(PlayerDistributions.STATS)))])
+            self._games = np.append(self._games, 0)
+        return self._index[steam_id]
+
+    def _apply(self, deltas):
+        for (steam_id, stat), delta in deltas.items():
+            row = self._row(steam_id)
+            if stat == 'games_played':
+                self._games[row] += delta
+            else:
+                self._counts[row, PlayerDistributions.STATS.index(stat)] += delta
+        self._sorted = None
+
+    def record_game(self, game_id, game: dict):
+        '''
+        Adds a stored game (insert_game_schema.json format) to the loaded totals, registered with Game.add_ingest_listener
+        '''
+        deltas = {}
+        def add(steam_id, stat):
+            key = (int(steam_id), stat)
+            deltas[key] = deltas.get(key, 0) + 1
+
+        for team in ("blu_team", "red_team"):
+            for player in game[team]["players"]:
+                add(player["steam_id"], 'games_played')
+        for score in game.get("scores", []):
+            add(score["scorer"], 'scores')
+        for steal in game.get("steals", []):
+            add(steal["stealer"], 'steals')
+            add(steal["victim"], 'stolen_from')
+        for game_pass in game.get("passes", []):
+            thrown, received = PlayerDistributions.PASS_STATS[game_pass["type"].upper()]
+            add(game_pass["passer"], thrown)
+            add(game_pass["catcher"], received)
+
+        shard = SHARDS.shard_for_date(game["date"]) if SHARDS is not None else None
+        with self._lock:
+            if self._pending is not None:
+                self._pending.append((game_id, shard, deltas))
+            # Nothing to update until something has asked for a percentile
+            if self._loaded_at is None:
+                return
+            self._apply(deltas)
+
+    def get_percentiles(self, steam_id):
+        '''
+        Returns {stat: percentile} of the player's per game rates, the percentile being the percent of
+        players whose rate is below theirs (players with the same rate count as half). Empty if the player hasn't played
+        '''
+        self._ensure_loaded()
+        with self._lock:
+            if self._sorted is None:
+                self._build()
+            if steam_id not in self._index or len(self._sorted) == 0:
+                return {}
+            rates = self._rates()[self._index[steam_id]]
+            population = len(self._sorted)
+            percentiles = {}
+            for j, stat in enumerate(PlayerDistributions.STATS):
+                below = np.searchsorted(self._sorted[:, j], rates[j], side='left')
+                at_or_below = np.searchsorted(self._sorted[:, j], rates[j], side='right')
+                percentiles[stat] = 100 * (below + at_or_below) / 2 / population
+            return percentiles
+
+    def get_histogram(self, stat):
+        '''
+        Returns (counts, bin_edges) of a stat's per game rates
+        '''
+        self._ensure_loaded()
+        with self._lock:
+            if self._sorted is None:
+                self._build()
+            return self._histograms[PlayerDistributions.STATS.index(stat)]
+
+    def serialize_percentiles(self, steam_id):
+        return {stat: round(float(percentile), 1) for stat, percentile in self.get_percentiles(steam_id).items()}
+
+    def serialize_histogram(self, stat):
+        counts, edges = self.get_histogram(stat)
+        return {
+            'stat': stat,
+            'counts': counts.tolist(),
+            'bin_edges': edges.tolist()
+        }
+
+
+DISTRIBUTIONS = PlayerDistributions(**config.get('percentiles', {}))
@@ -0,0 +1,194 @@
+import asyncio
+import json
+import queue
+import logging
+import threading
+import time
+
+from myorm import SHARDS, Game, config
+
+
+class Subscription():
+    '''
+    One /events/stream client. deliver(message) is called with each matching message and must not block.
+    steam_ids and maps are optional filters, a notice has to match both (when given) to be delivered
+    '''
+    def __init__(self, deliver, steam_ids: set[int] = None, maps: set[str] = None):
+        self.deliver = deliver
+        self.steam_ids = steam_ids
+        self.maps = maps
+
+    def matches(self, notice):
+        if self.steam_ids and self.steam_ids.isdisjoint(notice["steam_ids"]):
+            return False
+        if self.maps and notice["map"] not in self.maps:
+            return False
+        return True
+
+
+class GameEventBroadcaster():
+    '''
+    Fans a notice of every stored game out to the /events/stream subscribers. Fed by a GameTailer,
+    so subscribers see games stored by every server process, not just their own.
+
+    Each notice is encoded once and handed to the matching subscribers, found through an index on their
+    filters, so idle subscribers cost nothing but their queue and nobody queries the database.
+    '''
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._by_steam_id = {}
+        self._by_map = {}
+        self._unfiltered = set()
+
+    def _indexes(self, subscription):
+        # Each subscription is indexed under one filter only, the other is checked by matches()
+        if subscription.steam_ids:
+            return [self._by_steam_id.setdefault(steam_id, set()) for steam_id in subscription.steam_ids]
+        if subscription.maps:
+            return [self._by_map.setdefault(game_map, set()) for game_map in subscription.maps]
+        return [self._unfiltered]
+
+    def subscribe(self, subscription: Subscription):
+        with self._lock:
+            for index in self._indexes(subscription):
+                index.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        with self._lock:
+            for index in self._indexes(subscription):
+                index.discard(subscription)
+            # Don't keep empty sets around for every steam_id that was ever subscribed to
+            for steam_id in subscription.steam_ids or ():
+                if not self._by_steam_id.get(steam_id, True):
+                    del self._by_steam_id[steam_id]
+            for game_map in subscription.maps or ():
+                if not self._by_map.get(game_map, True):
+                    del self._by_map[game_map]
+
+    def publish(self, notice: dict):
+        '''
+        Sends a notice (see Game.get_game_notices) to every matching subscriber
+        '''
+        message = f"id: {notice['game_id']}\nevent: game\ndata: {json.dumps(notice)}\n\n"
+
+        with self._lock:
+            candidates = set(self._unfiltered)
+            for steam_id in notice["steam_ids"]:
+                candidates.update(self._by_steam_id.get(steam_id, ()))
+            candidates.update(self._by_map.get(notice["map"], ()))
+
+        for subscription in candidates:
+            if subscription.matches(notice):
+                subscription.deliver(message)
+
+
+class GameTailer():
+    '''
+    Polls the database for new games every interval seconds and publishes them to a broadcaster.
+    One per process, so it costs one query per poll however many subscribers are connected.
+
+    With sharding, game ids are handed out before the game is written to its shard, so a game can be
+    committed after one with a higher id. The last lookback ids are polled again to catch those.
+    '''
+    def __init__(self, broadcaster: GameEventBroadcaster, interval=1, lookback=100):
+        self.broadcaster = broadcaster
+        self.interval = interval
+        self.lookback = lookback if SHARDS is not None else 0
+        self._last_game_id = None
+        self._seen = set()
+        self._thread = None
+
+    def poll(self):
+        '''
+        Publishes the games stored since the last poll
+        '''
+        if self._last_game_id is None:
+            # Only games stored from now on are published, so the ones already in the lookback window count as seen
+            self._last_game_id = Game.get_last_game_id()
+            if self.lookback:
+                self._seen = {notice["game_id"] for notice in Game.get_game_notices(self._last_game_id - self.lookback)
+                              if notice["game_id"] <= self._last_game_id}
+            return
+        for notice in Game.get_game_notices(self._last_game_id - self.lookback):
+            if notice["game_id"] in self._seen or notice["game_id"] <= self._last_game_id - self.lookback:
+                continue
+            self.broadcaster.publish(notice)
+            if self.lookback:
+                self._seen.add(notice["game_id"])
+            self._last_game_id = max(self._last_game_id, notice["game_id"])
+        self._seen = {game_id for game_id in self._seen if game_id > self._last_game_id - self.lookback}
+
+    def _run(self):
+        while True:
+            try:
+                self.poll()
+            except Exception:
+                logging.exception("Polling for new games failed")
+            time.sleep(self.interval)
+
+    def start(self):
+        '''
+        Starts the background thread that polls for new games
+        '''
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="game-tailer", daemon=True)
+            self._thread.start()
+
+
+BROADCASTER = GameEventBroadcaster()
+
+EVENTS_CONFIG = config.get('events', {})
+# Seconds between SSE comments that keep idle connections (and proxies) from timing out
+KEEPALIVE = EVENTS_CONFIG.get('keepalive', 15)
+# Messages a slow subscriber can fall behind by before new ones are dropped for it
+QUEUE_SIZE = EVENTS_CONFIG.get('queue_size', 100)
+TAILER = GameTailer(BROADCASTER, EVENTS_CONFIG.get('poll_interval', 1), EVENTS_CONFIG.get('lookback', 100))
+KEEPALIVE_MESSAGE = ": keepalive\n\n"
+
+
+def _put_or_drop(message_queue, message):
+    try:
+        message_queue.put_nowait(message)
+    except (queue.Full, asyncio.QueueFull):
+        pass
+
+def stream_events(steam_ids=None, maps=None):
+    '''
+    Generator of SSE messages for a WSGI server, blocks its thread while waiting
+    '''
+    message_queue = queue.Queue(maxsize=QUEUE_SIZE)
+    subscription = BROADCASTER.subscribe(Subscription(lambda message: _put_or_drop(message_queue, message), steam_ids, maps))
+    try:
+        while True:
+            try:
+                yield message_queue.get(timeout=KEEPALIVE)
+            except queue.Empty:
+                yield KEEPALIVE_MESSAGE
+    finally:
+        BROADCASTER.unsubscribe(subscription)
+
+async def stream_events_async(steam_ids=None, maps=None):
+    '''
+    Async generator of SSE messages for an ASGI server, an idle subscriber is just a waiting coroutine
+    '''
+    loop = asyncio.get_running_loop()
+    message_queue = asyncio.Queue(maxsize=QUEUE_SIZE)
+
+    def deliver(message):
+        # Games are published from the ingesting thread, so the message is handed over to the event loop
+        try:
+            loop.call_soon_threadsafe(_put_or_drop, message_queue, message)
+        except RuntimeError:
+            # The loop has already been closed
+            pass
+
+    subscription = BROADCASTER.subscribe(Subscription(deliver, steam_ids, maps))
+    try:
+        while True:
+            try:
+                yield await asyncio.wait_for(message_queue.get(), KEEPALIVE)
+            except asyncio.TimeoutError:
+                yield KEEPALIVE_MESSAGE
+    finally:
+        BROADCASTER.unsubscribe(subscription)
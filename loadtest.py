@@ -0,0 +1,76 @@
+'''
+Small load tester for comparing server.py (WSGI) and asgi_server.py (ASGI).
+
+Opens `--connections` concurrent clients that each keep sending GET requests for `--duration` seconds,
+then prints throughput, latency percentiles and error counts. Only uses the standard library.
+
+Example comparison at 500 concurrent connections:
+    gunicorn -w 4 -b 127.0.0.1:8000 server:app
+    python loadtest.py http://127.0.0.1:8000/get_player_aggregate_stats?steam_id=76561198000000000 -c 500
+
+    hypercorn -w 4 -b 127.0.0.1:8001 asgi_server:app
+    python loadtest.py http://127.0.0.1:8001/get_player_aggregate_stats?steam_id=76561198000000000 -c 500
+'''
+import argparse
+import asyncio
+import time
+from urllib.parse import urlsplit
+
+
+async def _request(host, port, path, timeout):
+    reader, writer = await asyncio.wait_for(asyncio.open_connection(host, port), timeout)
+    try:
+        writer.write(f"GET {path} HTTP/1.1\r\nHost: {host}:{port}\r\nConnection: close\r\n\r\n".encode())
+        await writer.drain()
+        response = await asyncio.wait_for(reader.read(), timeout)
+    finally:
+        writer.close()
+    status_line = response.split(b"\r\n", 1)[0]
+    return int(status_line.split()[1])
+
+async def _client(host, port, path, deadline, timeout, latencies, statuses):
+    while time.monotonic() < deadline:
+        start = time.monotonic()
+        try:
+            status = await _request(host, port, path, timeout)
+        except (OSError, asyncio.TimeoutError, IndexError, ValueError) as e:
+            status = type(e).__name__
+        latencies.append(time.monotonic() - start)
+        statuses[status] = statuses.get(status, 0) + 1
+
+async def run(url, connections, duration, timeout):
+    parts = urlsplit(url)
+    path = parts.path + (f"?{parts.query}" if parts.query else "")
+    latencies = []
+    statuses = {}
+    deadline = time.monotonic() + duration
+    await asyncio.gather(*(_client(parts.hostname, parts.port or 80, path, deadline, timeout, latencies, statuses)
+                           for _ in range(connections)))
+    return latencies, statuses
+
+def _percentile(sorted_values, percent):
+    if not sorted_values:
+        return 0
+    index = min(len(sorted_values) - 1, int(len(sorted_values) * percent / 100))
+    return sorted_values[index]
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("url")
+    parser.add_argument("-c", "--connections", type=int, default=500)
+    parser.add_argument("-d", "--duration", type=float, default=30)
+    parser.add_argument("-t", "--timeout", type=float, default=30)
+    args = parser.parse_args()
+
+    latencies, statuses = asyncio.run(run(args.url, args.connections, args.duration, args.timeout))
+    latencies.sort()
+
+    print(f"requests:   {len(latencies)} in {args.duration}s ({len(latencies) / args.duration:.1f} req/s)")
+    for percent in (50, 90, 99):
+        print(f"p{percent}:        {_percentile(latencies, percent) * 1000:.1f} ms")
+    print(f"max:        {(latencies[-1] if latencies else 0) * 1000:.1f} ms")
+    for status, count in sorted(statuses.items(), key=lambda item: str(item[0])):
+        print(f"{status}: {count}")
+
+if __name__ == '__main__':
+    main()
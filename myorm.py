@@ -2,6 +2,13 @@ from enum import Enum
 
 import sqlite3
 import json
+import logging
+import hashlib
+import contextvars
+from contextlib import contextmanager
+
+from sharding import ShardRouter, ShardNotFoundError
+from replica import ReadReplica
 
 # Load configuration from config.json (or defaultconfig.json if config.json doesn't exist)
 try:
@@ -13,9 +20,81 @@ except Exception:
 
 # Use the database path from the configuration
 DATABASE = config['database_path']
+# How many rows generator queries pull from sqlite at a time
+FETCH_BATCH_SIZE = config.get('fetch_batch_size', 500)
+
+def get_db_connection(check_same_thread=True):
+    return sqlite3.connect(DATABASE, check_same_thread=check_same_thread)
+
+# Optional sharding mode, games are split into one file per month/season (see sharding.py)
+# and DATABASE is only used as the schema template for new shards
+SHARDS = None
+if config.get('sharding', {}).get('enabled'):
+    SHARDS = ShardRouter(DATABASE, **{key: value for key, value in config['sharding'].items() if key != 'enabled'})
+
+# Optional read replica, stat queries read from a copy of DATABASE that's refreshed in the background
+# (see replica.py) while writes and routes listed in primary_routes use DATABASE itself
+REPLICA_CONFIG = config.get('read_replica', {})
+REPLICA = None
+if REPLICA_CONFIG.get('enabled'):
+    if SHARDS is not None:
+        raise ValueError("read_replica can't be enabled together with sharding")
+    REPLICA = ReadReplica(DATABASE, **{key: value for key, value in REPLICA_CONFIG.items() if key not in ('enabled', 'primary_routes')})
+REPLICA_PRIMARY_ROUTES = set(REPLICA_CONFIG.get('primary_routes', []))
+
+# Set to True for requests that have to see their own writes
+READ_FROM_PRIMARY = contextvars.ContextVar('read_from_primary', default=False)
+
+@contextmanager
+def read_from_primary():
+    '''
+    Reads inside the with block go to DATABASE even when the read replica is enabled
+    '''
+    token = READ_FROM_PRIMARY.set(True)
+    try:
+        yield
+    finally:
+        READ_FROM_PRIMARY.reset(token)
 
-def get_db_connection():
-    return sqlite3.connect(DATABASE)
+def get_read_connection(check_same_thread=True):
+    '''
+    Returns a connection for read-only queries, to the read replica unless it's disabled or read_from_primary is set
+    '''
+    if REPLICA is None or READ_FROM_PRIMARY.get():
+        return get_db_connection(check_same_thread=check_same_thread)
+    return REPLICA.connect()
+
+def get_game_connection(game_id = None):
+    '''
+    Returns a connection to the database holding game_id (its shard when sharding is enabled)
+    '''
+    if SHARDS is None or game_id is None:
+        return get_read_connection()
+    try:
+        return SHARDS.connect_for_game(game_id)
+    except ShardNotFoundError:
+        raise GameNotFoundError()
+
+def select_fields(fields, available):
+    '''
+    Returns the names from `available` that are in `fields`, in the order of `available`.
+    If fields is None or doesn't name any of them, all of `available` is returned
+    '''
+    if fields is None:
+        return list(available)
+    selected = [field for field in available if field in fields]
+    return selected if selected else list(available)
+
+def iter_rows(cursor, query, params=(), batch_size=None):
+    '''
+    Yields the rows of a query a batch at a time (using fetchmany) instead of loading them all with fetchall
+    '''
+    cursor.execute(query, params)
+    while True:
+        rows = cursor.fetchmany(batch_size or FETCH_BATCH_SIZE)
+        if not rows:
+            return
+        yield from rows
 
 
 class GameNotFoundError(Exception):
@@ -101,6 +180,8 @@ class PlayerStats():
     
     @property
     def win_percentage(self):
+        if self.games_played == 0:
+            return 0
         return self.games_won / self.games_played
 
     def __add__(self, other):
@@ -164,8 +245,12 @@ class PlayerStats():
 
     @staticmethod
     def get_player_total_stats(player_id, cursor = None):     
+        if cursor is None and SHARDS is not None:
+            # Each shard is summed in parallel and the partial PlayerStats are added together
+            return sum(SHARDS.map(lambda cursor: PlayerStats.get_player_total_stats(player_id, cursor)), PlayerStats())
+
         if cursor is None:
-            connection = get_db_connection()
+            connection = get_read_connection()
             cursor = connection.cursor()
             close_cursor = True
         else:
@@ -219,19 +304,65 @@ class PlayerStats():
             stats.games_played = _execute_stat_query_and_get_total(GAMES_PLAYED_QUERY)        
             
             GAMES_WON_QUERY = "SELECT COUNT(*) from PlayerTeam LEFT JOIN TEAM on PlayerTeam.team_id = team.team_id where steam_id = ? AND winner = TRUE"
-            stats.games_played = _execute_stat_query_and_get_total(GAMES_WON_QUERY)        
+            stats.games_won = _execute_stat_query_and_get_total(GAMES_WON_QUERY)        
             
-            GAMES_LOST_QUERY = "SELECT COUNT(*) from PlayerTeam LEFT JOIN TEAM on PlayerTeam.team_id = team.team_id where steam_id = ? AND winner = FALSE"
-            stats.games_played = _execute_stat_query_and_get_total(GAMES_LOST_QUERY)        
+            GAMES_LOST_QUERY = "SELECT COUNT(*) from PlayerTeam LEFT JOIN TEAM on PlayerTeam.team_id = team.team_id LEFT JOIN TEAM as t2 ON team.game_id = t2.game_id AND team.team_id != t2.team_id where steam_id = ? AND t2.winner = TRUE"
+            stats.games_lost = _execute_stat_query_and_get_total(GAMES_LOST_QUERY)        
             
-            GAMES_DRAWN_QUERY = "SELECT COUNT(*) from Player LEFT JOIN TEAM on player.team_id = team.team_id LEFT JOIN TEAM as t2 ON team.game_id = t2.game_id AND team.team_id != t2.team_id where team.winner = t2.winner AND player.steam_id = ?"
-            stats.games_played = _execute_stat_query_and_get_total(GAMES_DRAWN_QUERY)
+            GAMES_DRAWN_QUERY = "SELECT COUNT(*) from PlayerTeam LEFT JOIN TEAM on PlayerTeam.team_id = team.team_id LEFT JOIN TEAM as t2 ON team.game_id = t2.game_id AND team.team_id != t2.team_id where team.winner = t2.winner AND PlayerTeam.steam_id = ?"
+            stats.games_drawn = _execute_stat_query_and_get_total(GAMES_DRAWN_QUERY)
             
             return stats
         finally:
             if close_cursor:
                 cursor.close()
 
+    LEADERBOARD_QUERIES = {
+        'scores': "SELECT scorer, COUNT(*) AS total from SCORE GROUP BY scorer ORDER BY total DESC",
+        'steals': "SELECT stealer, COUNT(*) AS total from STEAL GROUP BY stealer ORDER BY total DESC",
+        'stolen_from': "SELECT victim, COUNT(*) AS total from STEAL GROUP BY victim ORDER BY total DESC",
+        'team_passes_thrown': "SELECT passer, COUNT(*) AS total from TEAMPASS GROUP BY passer ORDER BY total DESC",
+        'team_passes_received': "SELECT catcher, COUNT(*) AS total from TEAMPASS GROUP BY catcher ORDER BY total DESC",
+        'intercepts_thrown': "SELECT passer, COUNT(*) AS total from INTERCEPT GROUP BY passer ORDER BY total DESC",
+        'intercepts_received': "SELECT catcher, COUNT(*) AS total from INTERCEPT GROUP BY catcher ORDER BY total DESC",
+        'blocks_thrown': "SELECT passer, COUNT(*) AS total from BLOCK GROUP BY passer ORDER BY total DESC",
+        'blocks_received': "SELECT catcher, COUNT(*) AS total from BLOCK GROUP BY catcher ORDER BY total DESC",
+        'assists_thrown': "SELECT passer, COUNT(*) AS total from ASSIST GROUP BY passer ORDER BY total DESC",
+        'assists_received': "SELECT catcher, COUNT(*) AS total from ASSIST GROUP BY catcher ORDER BY total DESC",
+        'games_played': "SELECT steam_id, COUNT(*) AS total from PlayerTeam GROUP BY steam_id ORDER BY total DESC",
+    }
+
+    @staticmethod
+    def iter_leaderboard(stat, cursor = None):
+        '''
+        Yields (steam_id, total) tuples for a stat, highest first
+        '''
+        if stat not in PlayerStats.LEADERBOARD_QUERIES:
+            raise ValueError(f"Unknown leaderboard stat: {stat}")
+
+        if cursor is None and SHARDS is not None:
+            # A player's total is spread over every shard, so the totals have to be merged before sorting
+            totals = {}
+            for shard_totals in SHARDS.map(lambda cursor: cursor.execute(PlayerStats.LEADERBOARD_QUERIES[stat]).fetchall()):
+                for steam_id, total in shard_totals:
+                    totals[steam_id] = totals.get(steam_id, 0) + total
+            yield from sorted(totals.items(), key=lambda row: row[1], reverse=True)
+            return
+
+        if cursor is None:
+            # Generators can be resumed on a different thread than the one that started them
+            connection = get_read_connection(check_same_thread=False)
+            cursor = connection.cursor()
+            close_cursor = True
+        else:
+            close_cursor = False
+
+        try:
+            yield from iter_rows(cursor, PlayerStats.LEADERBOARD_QUERIES[stat])
+        finally:
+            if close_cursor:
+                cursor.close()
+
     def serialize(self):
         return {
             'scores': self.scores,
@@ -321,7 +452,7 @@ class PlayerTeamStats():
     @staticmethod
     def get_player_team_stats(player_id, team_id, cursor = None):     
         if cursor is None:
-            connection = get_db_connection()
+            connection = get_read_connection()
             cursor = connection.cursor()
             close_cursor = True
         else:
@@ -375,8 +506,8 @@ class PlayerTeamStats():
             if close_cursor:
                 cursor.close()
 
-    def serialize(self):
-        return {
+    def serialize(self, fields: list[str] = None):
+        res = {
             'scores': self.scores,
             'steals': self.steals,
             'stolen_from': self.stolen_from,
@@ -389,6 +520,9 @@ class PlayerTeamStats():
             'assists_thrown': self.assists_thrown,
             'assists_received': self.assists_received
         }
+        if fields is None:
+            return res
+        return {field: res[field] for field in select_fields(fields, res)}
 
 class Player():
     '''
@@ -399,9 +533,15 @@ class Player():
     
     @property
     def aliases(self):
-        connection = get_db_connection()
-        cursor = connection.cursor()
         ALIAS_QUERY = "SELECT alias FROM PlayerTeam WHERE steam_id = ? GROUP BY alias"
+        if SHARDS is not None:
+            aliases = set()
+            for res in SHARDS.map(lambda cursor: cursor.execute(ALIAS_QUERY, (self.steam_id,)).fetchall()):
+                aliases.update(row[0] for row in res)
+            return sorted(aliases)
+
+        connection = get_read_connection()
+        cursor = connection.cursor()
         cursor.execute(ALIAS_QUERY, (self.steam_id,))
         res = cursor.fetchall()
         cursor.close()
@@ -413,7 +553,7 @@ class Player():
         Returns a list of Player objects
         '''
         if cursor is None:
-            connection = get_db_connection()
+            connection = get_read_connection()
             cursor = connection.cursor()
             close_cursor = True
         else:
@@ -430,11 +570,14 @@ class Player():
             if close_cursor:
                 cursor.close()
 
-    def serialize(self):
-        return {
+    def serialize(self, include_aliases=False):
+        res = {
             'steam_id': self.steam_id,
             'alias': self.alias
         }
+        if include_aliases:
+            res['aliases'] = self.aliases
+        return res
                 
     def __hash__(self):
         return self.steam_id
@@ -448,16 +591,35 @@ class TeamStats():
     """
     Stats for a whole team of players
     """
-    def __init__(self, player_stats: dict[str, PlayerTeamStats]):
+    # Each PlayerTeamStats field and the query that gets it for every player on a team
+    STAT_QUERIES = {
+        'scores': "SELECT scorer, COUNT(*) from SCORE WHERE team_id = ? GROUP BY scorer",
+        'steals': "SELECT stealer, COUNT(*) from STEAL WHERE stealer_team_id = ? GROUP BY stealer",
+        'stolen_from': "SELECT victim, COUNT(*) from STEAL WHERE victim_team_id = ? GROUP BY victim",
+        'team_passes_thrown': "SELECT passer, COUNT(*) from TEAMPASS WHERE team_id = ? GROUP BY passer",
+        'team_passes_received': "SELECT catcher, COUNT(*) from TEAMPASS WHERE team_id = ? GROUP BY catcher",
+        'intercepts_thrown': "SELECT passer, COUNT(*) from INTERCEPT WHERE passer_team_id = ? GROUP BY passer",
+        'intercepts_received': "SELECT catcher, COUNT(*) from INTERCEPT WHERE catcher_team_id = ? GROUP BY catcher",
+        'blocks_thrown': "SELECT passer, COUNT(*) from BLOCK WHERE passer_team_id = ? GROUP BY passer",
+        'blocks_received': "SELECT catcher, COUNT(*) from BLOCK WHERE catcher_team_id = ? GROUP BY catcher",
+        'assists_thrown': "SELECT passer, COUNT(*) from ASSIST WHERE team_id = ? GROUP BY passer",
+        'assists_received': "SELECT catcher, COUNT(*) from ASSIST WHERE team_id = ? GROUP BY catcher",
+    }
+
+    def __init__(self, player_stats: dict[str, PlayerTeamStats], fields: list[str] = None):
         self.player_stats = player_stats
+        self.fields = fields
 
     # TODO: Add other properties here which iterate through player_stats and get's stuff (like total goals)
     # don't forget to serialize them too
 
     @staticmethod
-    def get_team_stats(team_id, players: list[Player] = None, cursor = None):     
+    def get_team_stats(team_id, players: list[Player] = None, cursor = None, fields: list[str] = None):
+        '''
+        Only the stats named in `fields` are queried (all of them if fields is None)
+        '''
         if cursor is None:
-            connection = get_db_connection()
+            connection = get_read_connection()
             cursor = connection.cursor()
             close_cursor = True
         else:
@@ -466,6 +628,8 @@ class TeamStats():
         if players is None:
             players = Player.get_players_from_team_id(team_id, cursor)
 
+        fields = select_fields(fields, TeamStats.STAT_QUERIES)
+
         def _execute_stat_query_and_get_total(query):
             cursor.execute(query, (team_id,))
             res = cursor.fetchall()
@@ -479,110 +643,120 @@ class TeamStats():
             
             for player in players:
                 player_stats[player.steam_id] = PlayerTeamStats()
-                    
-            SCORES_QUERY = "SELECT scorer, COUNT(*) from SCORE WHERE team_id = ? GROUP BY scorer"
-            res = _execute_stat_query_and_get_total(SCORES_QUERY)
-            for key, val in res.items():
-                player_stats[key].scores = val
-            
-            STEALS_QUERY = "SELECT stealer, COUNT(*) from STEAL WHERE stealer_team_id = ? GROUP BY stealer"
-            res = _execute_stat_query_and_get_total(STEALS_QUERY)
-            for key, val in res.items():
-                player_stats[key].steals = val
-            
-            STOLEN_FROM_QUERY = "SELECT victim, COUNT(*) from STEAL WHERE victim_team_id = ? GROUP BY victim"
-            res = _execute_stat_query_and_get_total(STOLEN_FROM_QUERY)
-            for key, val in res.items():
-                player_stats[key].stolen_from = val
-
-            TEAM_PASSES_THROWN_QUERY = "SELECT passer, COUNT(*) from TEAMPASS WHERE team_id = ? GROUP BY passer"
-            res = _execute_stat_query_and_get_total(TEAM_PASSES_THROWN_QUERY)
-            for key, val in res.items():
-                player_stats[key].team_passes_thrown = val
-            
-            TEAM_PASSES_RECEIVED_QUERY = "SELECT catcher, COUNT(*) from TEAMPASS WHERE team_id = ? GROUP BY catcher"
-            res = _execute_stat_query_and_get_total(TEAM_PASSES_RECEIVED_QUERY)
-            for key, val in res.items():
-                player_stats[key].team_passes_received = val
-
-            INTERCEPTS_THROWN_QUERY = "SELECT passer, COUNT(*) from INTERCEPT WHERE passer_team_id = ? GROUP BY passer"
-            res = _execute_stat_query_and_get_total(INTERCEPTS_THROWN_QUERY)
-            for key, val in res.items():
-                player_stats[key].intercepts_thrown = val
-            
-            INTERCEPTS_RECEIVED_QUERY = "SELECT catcher, COUNT(*) from INTERCEPT WHERE catcher_team_id = ? GROUP BY catcher"
-            res = _execute_stat_query_and_get_total(INTERCEPTS_RECEIVED_QUERY)
-            for key, val in res.items():
-                player_stats[key].intercepts_received = val
-
-            BLOCKS_THROWN_QUERY = "SELECT passer, COUNT(*) from BLOCK WHERE passer_team_id = ? GROUP BY passer"
-            res = _execute_stat_query_and_get_total(BLOCKS_THROWN_QUERY)
-            for key, val in res.items():
-                player_stats[key].blocks_thrown = val
-            
-            BLOCKS_RECEIVED_QUERY = "SELECT catcher, COUNT(*) from BLOCK WHERE catcher_team_id = ? GROUP BY catcher"
-            res = _execute_stat_query_and_get_total(BLOCKS_RECEIVED_QUERY)
-            for key, val in res.items():
-                player_stats[key].blocks_received = val
-
-            ASSISTS_THROWN_QUERY = "SELECT passer, COUNT(*) from ASSIST WHERE team_id = ? GROUP BY passer"
-            res = _execute_stat_query_and_get_total(ASSISTS_THROWN_QUERY)
-            for key, val in res.items():
-                player_stats[key].assists_thrown = val
-            
-            ASSISTS_RECEIVED_QUERY = "SELECT catcher, COUNT(*) from ASSIST WHERE team_id = ? GROUP BY catcher"
-            res = _execute_stat_query_and_get_total(ASSISTS_RECEIVED_QUERY)
-            for key, val in res.items():
-                player_stats[key].assists_received = val      
 
-            return TeamStats(player_stats)
+            for field in fields:
+                res = _execute_stat_query_and_get_total(TeamStats.STAT_QUERIES[field])
+                for key, val in res.items():
+                    setattr(player_stats[key], field, val)
+
+            return TeamStats(player_stats, fields)
         finally:
             if close_cursor:
                 cursor.close()
 
     def serialize(self):
-        return {player:stats.serialize() for player, stats in self.player_stats.items()}
+        return {player:stats.serialize(self.fields) for player, stats in self.player_stats.items()}
 
 class Team():
     '''
     This represent one team for one Game
     '''
-    def __init__(self, team_id, team_name, players: list[Player]):
+    # What Team.serialize includes when the caller doesn't say
+    DEFAULT_INCLUDE = ('players', 'team_stats')
+
+    def __init__(self, team_id, team_name, players: list[Player] = None, game_id = None):
         self.id = team_id
         self.name = team_name
-        self.players = players
+        self.game_id = game_id
+        self._players = players
         self._team_stats = None
 
+    def _cursor(self):
+        # Team ids are only unique within a shard, so the team's queries go to its game's database
+        return get_game_connection(self.game_id).cursor()
+
+    @property
+    def players(self):
+        if self._players is None:
+            cursor = self._cursor()
+            try:
+                self._players = Player.get_players_from_team_id(self.id, cursor)
+            finally:
+                cursor.close()
+        return self._players
+
     @property
     def team_stats(self):
         if self._team_stats is None:
-            self._team_stats = TeamStats.get_team_stats(team_id = self.id, players = self.players)
+            self._team_stats = self._get_team_stats()
         return self._team_stats
+
+    def _get_team_stats(self, fields: list[str] = None):
+        cursor = self._cursor()
+        try:
+            return TeamStats.get_team_stats(team_id = self.id, players = self.players, cursor = cursor, fields = fields)
+        finally:
+            cursor.close()
+
+    def get_team_stats(self, fields: list[str] = None):
+        '''
+        Like team_stats, but only queries the stats named in `fields`
+        '''
+        if self._team_stats is not None or select_fields(fields, TeamStats.STAT_QUERIES) == list(TeamStats.STAT_QUERIES):
+            return self.team_stats
+        return self._get_team_stats(fields)
+
+    def get_player_stats(self, steam_id):
+        '''
+        Returns the PlayerTeamStats of one player on this team
+        '''
+        cursor = self._cursor()
+        try:
+            return PlayerTeamStats.get_player_team_stats(steam_id, self.id, cursor)
+        finally:
+            cursor.close()
  
-    def serialize(self):
-        return {
+    def serialize(self, include: list[str] = None, fields: list[str] = None):
+        '''
+        include can name 'players', 'aliases' (players with all their aliases) and 'team_stats'
+        fields limits which stats are in team_stats
+        '''
+        if include is None:
+            include = Team.DEFAULT_INCLUDE
+        res = {
             'id': self.id,
-            'name': self.name,
-            'players': [p.serialize() for p in self.players],
+            'name': self.name
+        }
+        if 'players' in include or 'aliases' in include:
+            res['players'] = [p.serialize(include_aliases = 'aliases' in include) for p in self.players]
+        if 'team_stats' in include:
             # TODO: consider moving each PlayerTeamStats in team_stats to the 'players' list
             # 'players': [p.serialize() | {"stats":self.team_stats.player_stats[p.steam_id]} for p in self.players],
-            'team_stats': self.team_stats.serialize()
-        }
+            res['team_stats'] = self.get_team_stats(fields).serialize()
+        return res
  
     @staticmethod
-    def parse_and_store(team: dict):
-        name = team["name"]
-        players = Players.parse_and_store(team["players"])
+    def parse_and_store(team: dict, team_color, game_id, winner, cursor):
+        '''
+        Inserts the team and its players, returns the new team_id
+        '''
+        TEAM_INSERT = "INSERT INTO Team (team_name, team_color, game_id, winner) VALUES (?, ?, ?, ?)"
+        cursor.execute(TEAM_INSERT, (team["name"], team_color, game_id, winner))
+        team_id = cursor.lastrowid
+
+        PLAYER_TEAM_INSERT = "INSERT INTO PlayerTeam (steam_id, team_id, alias) VALUES (?, ?, ?)"
+        cursor.executemany(PLAYER_TEAM_INSERT, [(int(player["steam_id"]), team_id, player["alias"]) for player in team["players"]])
+        return team_id
 
     @staticmethod
     def get_teams_from_game_id(game_id, cursor = None):
         '''
         Returns a tuple of (blu_team, red_team, game_result)
-        blu_team and red_team are both Team objects
+        blu_team and red_team are both Team objects, their players are loaded when first used
         game_result is a GameResult object
         '''
         if cursor is None:
-            connection = get_db_connection()
+            connection = get_read_connection()
             cursor = connection.cursor()
             close_cursor = True
         else:
@@ -597,11 +771,11 @@ class Team():
             blu_team_id = res[0][0]
             blu_team_name = res[0][1]
             blu_team_winner = res[0][2]
-            blu_team = Team(blu_team_id, blu_team_name, Player.get_players_from_team_id(blu_team_id, cursor))
+            blu_team = Team(blu_team_id, blu_team_name, game_id = game_id)
             red_team_id = res[1][0]
             red_team_name = res[1][1]
             red_team_winner = res[1][2]
-            red_team = Team(red_team_id, red_team_name, Player.get_players_from_team_id(red_team_id, cursor))
+            red_team = Team(red_team_id, red_team_name, game_id = game_id)
             if blu_team_winner == red_team_winner:
                 game_result = GameResult.DRAW
             elif blu_team_winner:
@@ -633,26 +807,256 @@ class Game():
         self.red_team = red_team
         self.game_result = game_result
 
+    # Which table each pass "type" in insert_game_schema.json goes into
+    PASS_INSERTS = {
+        "TEAM": "INSERT INTO TeamPass (team_id, passer, catcher) VALUES (?, ?, ?)",
+        "ASSIST": "INSERT INTO Assist (team_id, passer, catcher) VALUES (?, ?, ?)",
+        "INTERCEPT": "INSERT INTO Intercept (passer_team_id, catcher_team_id, passer, catcher) VALUES (?, ?, ?, ?)",
+        "BLOCK": "INSERT INTO Block (passer_team_id, catcher_team_id, passer, catcher) VALUES (?, ?, ?, ?)",
+    }
+
+    # Called with (game_id, game) after a game is committed, see add_ingest_listener
+    _ingest_listeners = []
+
+    @staticmethod
+    def add_ingest_listener(listener):
+        '''
+        Registers listener(game_id, game: dict) to be called after each stored game is committed.
+        Listeners run in the ingesting thread, so they should be quick
+        '''
+        Game._ingest_listeners.append(listener)
+
+    @staticmethod
+    def notify_ingest(game_id, game: dict):
+        '''
+        Calls the ingest listeners. parse_and_store_game does this itself unless the caller passed a cursor,
+        in which case the caller should call it after committing
+        '''
+        for listener in Game._ingest_listeners:
+            try:
+                listener(game_id, game)
+            except Exception:
+                # The game is already committed, a broken listener shouldn't turn that into an error
+                logging.getLogger(__name__).exception("Ingest listener failed for game %s", game_id)
+
+    @staticmethod
+    def content_hash(game: dict):
+        '''
+        SHA-256 of the game's canonical JSON (sorted keys, no whitespace), so a retried upload of the same
+        payload always gets the same hash
+        '''
+        return hashlib.sha256(json.dumps(game, sort_keys=True, separators=(",", ":")).encode()).hexdigest()
+
+    # Most hashes that fit in one "IN (...)" query
+    HASH_LOOKUP_BATCH_SIZE = 500
+
+    @staticmethod
+    def find_games_by_hash(content_hashes: list[str], cursor):
+        '''
+        Returns {content_hash: game_id} for the hashes that are already stored
+        '''
+        found = {}
+        content_hashes = list(set(content_hashes))
+        for i in range(0, len(content_hashes), Game.HASH_LOOKUP_BATCH_SIZE):
+            batch = content_hashes[i:i + Game.HASH_LOOKUP_BATCH_SIZE]
+            HASH_QUERY = f"SELECT content_hash, game_id FROM Game WHERE content_hash IN ({','.join('?' * len(batch))})"
+            cursor.execute(HASH_QUERY, batch)
+            found.update(cursor.fetchall())
+        return found
+
+    @staticmethod
+    def parse_and_store_game(game: dict, cursor = None):
+        '''
+        Stores a game in the format of insert_game_schema.json and returns its game_id.
+        If the same payload was already stored (e.g. a retried upload), nothing is written and the existing game_id is returned.
+        If no cursor is given, the game is committed in its own transaction, otherwise the caller commits
+        '''
+        content_hash = Game.content_hash(game)
+
+        if cursor is None and SHARDS is not None:
+            game_id, stored = Game._parse_and_store_sharded_game(game, content_hash)
+            if stored:
+                Game.notify_ingest(game_id, game)
+            return game_id
+
+        if cursor is None:
+            connection = get_db_connection()
+            cursor = connection.cursor()
+            close_cursor = True
+        else:
+            close_cursor = False
+
+        try:
+            # Checked before anything is written, so a duplicate never opens a write transaction
+            existing = Game.find_games_by_hash([content_hash], cursor)
+            if content_hash in existing:
+                return existing[content_hash]
+
+            try:
+                game_id = Game._store_game(game, cursor, content_hash = content_hash)
+            except sqlite3.IntegrityError:
+                # The same game may have been stored by another request since the check
+                if not close_cursor:
+                    raise
+                connection.rollback()
+                existing = Game.find_games_by_hash([content_hash], cursor)
+                if content_hash in existing:
+                    return existing[content_hash]
+                raise
+            if close_cursor:
+                connection.commit()
+        except Exception:
+            if close_cursor:
+                connection.rollback()
+            raise
+        finally:
+            if close_cursor:
+                cursor.close()
+
+        if close_cursor:
+            Game.notify_ingest(game_id, game)
+        return game_id
+
+    @staticmethod
+    def parse_and_store_games(games: list[dict]):
+        '''
+        Stores many games and returns their game_ids in the same order. Games that are already stored, or appear
+        earlier in the list, get the existing game_id. Stored games are found with one query per
+        HASH_LOOKUP_BATCH_SIZE games, and (without sharding) all new games are committed in one transaction
+        '''
+        content_hashes = [Game.content_hash(game) for game in games]
+
+        if SHARDS is not None:
+            existing = SHARDS.find_games(content_hashes)
+            game_ids = []
+            for game, content_hash in zip(games, content_hashes):
+                if content_hash not in existing:
+                    game_id, stored = Game._parse_and_store_sharded_game(game, content_hash)
+                    existing[content_hash] = game_id
+                    if stored:
+                        Game.notify_ingest(game_id, game)
+                game_ids.append(existing[content_hash])
+            return game_ids
+
+        connection = get_db_connection()
+        cursor = connection.cursor()
+        try:
+            for attempt in range(2):
+                game_ids = []
+                stored = []
+                try:
+                    existing = Game.find_games_by_hash(content_hashes, cursor)
+                    for game, content_hash in zip(games, content_hashes):
+                        if content_hash not in existing:
+                            existing[content_hash] = Game._store_game(game, cursor, content_hash = content_hash)
+                            stored.append((existing[content_hash], game))
+                        game_ids.append(existing[content_hash])
+                    connection.commit()
+                    break
+                except sqlite3.IntegrityError:
+                    # Another request may have stored some of the games since they were looked up. Nothing of this
+                    # batch was committed, so look the hashes up again and store the rest once more
+                    connection.rollback()
+                    if attempt:
+                        raise
+                except Exception:
+                    connection.rollback()
+                    raise
+        finally:
+            cursor.close()
+
+        for game_id, game in stored:
+            Game.notify_ingest(game_id, game)
+        return game_ids
+
+    @staticmethod
+    def _parse_and_store_sharded_game(game: dict, content_hash):
+        '''
+        Returns (game_id, stored), stored is False when a game with this content_hash was already stored
+        '''
+        # The catalog only knows the hash of games committed to their shard, so a hit here is always a stored game
+        existing = SHARDS.find_games([content_hash])
+        if content_hash in existing:
+            return existing[content_hash], False
+
+        # The catalog hands out the game_id so ids stay unique across shards. Copies of a game have the same date,
+        # so they go to the same shard, where the unique content_hash index lets only one of them be committed
+        game_id, shard = SHARDS.allocate_game_id(game["date"])
+        connection = SHARDS.connect(shard, write=True)
+        cursor = connection.cursor()
+        try:
+            try:
+                Game._store_game(game, cursor, game_id, content_hash)
+                connection.commit()
+            except Exception as error:
+                connection.rollback()
+                SHARDS.release_game_id(game_id)
+                if not isinstance(error, sqlite3.IntegrityError):
+                    raise
+                # Another request stored the same game since the catalog was checked
+                existing = Game.find_games_by_hash([content_hash], cursor)
+                if content_hash not in existing:
+                    raise
+                game_id = existing[content_hash]
+                # In case that request didn't get to confirm it
+                SHARDS.confirm_game(game_id, content_hash)
+                return game_id, False
+        finally:
+            cursor.close()
+            connection.close()
+
+        SHARDS.confirm_game(game_id, content_hash)
+        return game_id, True
+
     @staticmethod
-    def parse_and_store_game(game: dict):
+    def _store_game(game: dict, cursor, game_id = None, content_hash = None):
         # TODO PARSE THESE
         date = game["date"]
         duration = game["duration"]
         map = game["map"]
         game_result = GameResult.parse(game["game_result"])
 
-        # create game in db
-        pass
+        GAME_INSERT = "INSERT INTO Game (game_id, game_date, game_duration, game_map, content_hash) VALUES (?, ?, ?, ?, ?)"
+        cursor.execute(GAME_INSERT, (game_id, date, duration, map, content_hash))
+        game_id = cursor.lastrowid
 
-        # probably pass in cursor (and idk how to make it know who the winner is)
-        blu_team = Team.parse_and_store(game["blu_team"])
-        red_team = Team.parse_and_store(game["red_team"])
+        team_ids = {
+            "BLU": Team.parse_and_store(game["blu_team"], "BLU", game_id, game_result == GameResult.BLU_VICTORY, cursor),
+            "RED": Team.parse_and_store(game["red_team"], "RED", game_id, game_result == GameResult.RED_VICTORY, cursor),
+        }
 
+        SCORE_INSERT = "INSERT INTO Score (team_id, scorer) VALUES (?, ?)"
+        cursor.executemany(SCORE_INSERT, [(team_ids[score["team"].upper()], int(score["scorer"])) for score in game.get("scores", [])])
+
+        STEAL_INSERT = "INSERT INTO Steal (victim_team_id, stealer_team_id, victim, stealer) VALUES (?, ?, ?, ?)"
+        cursor.executemany(STEAL_INSERT, [(team_ids[steal["victim_team"].upper()], team_ids[steal["stealer_team"].upper()],
+                                           int(steal["victim"]), int(steal["stealer"])) for steal in game.get("steals", [])])
+
+        for game_pass in game.get("passes", []):
+            pass_type = game_pass["type"].upper()
+            passer_team_id = team_ids[game_pass["passer_team"].upper()]
+            catcher_team_id = team_ids[game_pass["catcher_team"].upper()]
+            passer = int(game_pass["passer"])
+            catcher = int(game_pass["catcher"])
+            if pass_type in ("TEAM", "ASSIST"):
+                cursor.execute(Game.PASS_INSERTS[pass_type], (passer_team_id, passer, catcher))
+            else:
+                cursor.execute(Game.PASS_INSERTS[pass_type], (passer_team_id, catcher_team_id, passer, catcher))
+
+        MapSummary.record_game(
+            map, date, duration, game_result,
+            red_scores = sum(1 for score in game.get("scores", []) if score["team"].upper() == "RED"),
+            blu_scores = sum(1 for score in game.get("scores", []) if score["team"].upper() == "BLU"),
+            red_steals = sum(1 for steal in game.get("steals", []) if steal["stealer_team"].upper() == "RED"),
+            blu_steals = sum(1 for steal in game.get("steals", []) if steal["stealer_team"].upper() == "BLU"),
+            cursor = cursor)
+
+        return game_id
 
     @staticmethod
     def get_game(game_id, cursor = None):
         if cursor is None:
-            connection = get_db_connection()
+            connection = get_game_connection(game_id)
             cursor = connection.cursor()
             close_cursor = True
         else:
@@ -674,7 +1078,136 @@ class Game():
         finally:
             if close_cursor:
                 cursor.close()
-  
+
+    @staticmethod
+    def iter_games(game_ids, cursor = None):
+        '''
+        Yields a Game for each game_id, one at a time. Game ids that don't exist are skipped
+        '''
+        if cursor is None and SHARDS is not None:
+            # Each game is looked up in its own shard
+            for game_id in game_ids:
+                try:
+                    yield Game.get_game(game_id)
+                except (GameNotFoundError, TeamNotFoundError, PlayersNotFoundError):
+                    continue
+            return
+
+        if cursor is None:
+            # Generators can be resumed on a different thread than the one that started them
+            connection = get_read_connection(check_same_thread=False)
+            cursor = connection.cursor()
+            close_cursor = True
+        else:
+            close_cursor = False
+
+        try:
+            for game_id in game_ids:
+                try:
+                    yield Game.get_game(game_id, cursor)
+                except (GameNotFoundError, TeamNotFoundError, PlayersNotFoundError):
+                    continue
+        finally:
+            if close_cursor:
+                cursor.close()
+
+    @staticmethod
+    def iter_player_game_ids(steam_id, cursor = None):
+        '''
+        Yields the id of every game a player played in, newest first
+        '''
+        if cursor is None and SHARDS is not None:
+            # Shards are split by date, so going through them newest first keeps the games in order
+            for shard in reversed(SHARDS.shards()):
+                connection = SHARDS.connect(shard)
+                try:
+                    yield from Game.iter_player_game_ids(steam_id, connection.cursor())
+                finally:
+                    connection.close()
+            return
+
+        if cursor is None:
+            # Generators can be resumed on a different thread than the one that started them
+            connection = get_read_connection(check_same_thread=False)
+            cursor = connection.cursor()
+            close_cursor = True
+        else:
+            close_cursor = False
+
+        try:
+            PLAYER_GAMES_QUERY = "SELECT DISTINCT Team.game_id, game_date from PlayerTeam JOIN Team on PlayerTeam.team_id = Team.team_id JOIN GAME on Team.game_id = Game.game_id WHERE steam_id = ? ORDER BY game_date DESC"
+            for row in iter_rows(cursor, PLAYER_GAMES_QUERY, (steam_id,)):
+                yield row[0]
+        finally:
+            if close_cursor:
+                cursor.close()
+
+    @staticmethod
+    def get_game_notices(after_game_id, cursor = None):
+        '''
+        Returns [{game_id, date, map, game_result, steam_ids}] of the games with a game_id above after_game_id, oldest first.
+        Always read from the primary (with sharding, from the shards the catalog has newer games in) so new games show up at once
+        '''
+        if cursor is None and SHARDS is not None:
+            shards = SHARDS.shards_after(after_game_id)
+            notices = [notice for res in SHARDS.map(lambda cursor: Game.get_game_notices(after_game_id, cursor), shards) for notice in res]
+            return sorted(notices, key=lambda notice: notice["game_id"])
+
+        if cursor is None:
+            connection = get_db_connection()
+            cursor = connection.cursor()
+            close_cursor = True
+        else:
+            close_cursor = False
+
+        try:
+            GAME_NOTICES_QUERY = '''
+                SELECT Game.game_id, game_date, game_map, team_color, winner, steam_id FROM Game
+                JOIN Team ON Team.game_id = Game.game_id
+                LEFT JOIN PlayerTeam ON PlayerTeam.team_id = Team.team_id
+                WHERE Game.game_id > ? ORDER BY Game.game_id
+            '''
+            notices = {}
+            winners = {}
+            for game_id, game_date, game_map, team_color, winner, steam_id in iter_rows(cursor, GAME_NOTICES_QUERY, (after_game_id,)):
+                notice = notices.setdefault(game_id, {"game_id": game_id, "date": game_date, "map": game_map, "steam_ids": set()})
+                winners.setdefault(game_id, {})[team_color] = winner
+                if steam_id is not None:
+                    notice["steam_ids"].add(steam_id)
+            for game_id, notice in notices.items():
+                if winners[game_id].get("BLU") == winners[game_id].get("RED"):
+                    notice["game_result"] = GameResult.DRAW
+                elif winners[game_id].get("BLU"):
+                    notice["game_result"] = GameResult.BLU_VICTORY
+                else:
+                    notice["game_result"] = GameResult.RED_VICTORY
+                notice["steam_ids"] = sorted(notice["steam_ids"])
+            return list(notices.values())
+        finally:
+            if close_cursor:
+                cursor.close()
+
+    @staticmethod
+    def get_last_game_id(cursor = None):
+        '''
+        Returns the highest stored game_id (0 if there are no games), read from the primary or the shard catalog
+        '''
+        if cursor is None and SHARDS is not None:
+            return SHARDS.last_game_id()
+
+        if cursor is None:
+            connection = get_db_connection()
+            cursor = connection.cursor()
+            close_cursor = True
+        else:
+            close_cursor = False
+
+        try:
+            return cursor.execute("SELECT MAX(game_id) FROM Game").fetchone()[0] or 0
+        finally:
+            if close_cursor:
+                cursor.close()
+
     def __hash__(self):
         return self.id
 
@@ -683,15 +1216,197 @@ class Game():
             return self.id == other.id
         return False
 
+    FIELDS = ('id', 'date', 'duration', 'map', 'blu_team', 'red_team', 'game_result')
+
+    def serialize(self, fields: list[str] = None, include: list[str] = None):
+        '''
+        fields picks which game fields (and which team stats) are returned, include is passed on to Team.serialize.
+        Teams are only loaded if 'blu_team' or 'red_team' is one of the fields
+        '''
+        res = {}
+        for field in select_fields(fields, Game.FIELDS):
+            if field == 'id':
+                res['id'] = self.id
+            elif field == 'date':
+                res['date'] = self.date
+            elif field == 'duration':
+                res['duration'] = self.duration
+            elif field == 'map':
+                res['map'] = self.map
+            elif field == 'blu_team':
+                res['blu_team'] = self.blu_team.serialize(include, fields)
+            elif field == 'red_team':
+                res['red_team'] = self.red_team.serialize(include, fields)
+            elif field == 'game_result':
+                res['game_result'] = self.game_result
+        return res
+
+class MapSummary():
+    '''
+    Totals for one map over a range of days, added up from the MapDailyRollup buckets
+    '''
+    def __init__(self, game_map, games_played=0, total_duration=0, red_wins=0, blu_wins=0, draws=0,
+                 red_scores=0, blu_scores=0, red_steals=0, blu_steals=0):
+        self.map = game_map
+        self.games_played = games_played
+        self.total_duration = total_duration
+        self.red_wins = red_wins
+        self.blu_wins = blu_wins
+        self.draws = draws
+        self.red_scores = red_scores
+        self.blu_scores = blu_scores
+        self.red_steals = red_steals
+        self.blu_steals = blu_steals
+
+    def _per_game(self, total):
+        if self.games_played == 0:
+            return 0
+        return total / self.games_played
+
+    @property
+    def average_duration(self):
+        return self._per_game(self.total_duration)
+
+    @property
+    def average_scores(self):
+        return self._per_game(self.red_scores + self.blu_scores)
+
+    @property
+    def average_steals(self):
+        return self._per_game(self.red_steals + self.blu_steals)
+
+    def __add__(self, other):
+        if not isinstance(other, MapSummary):
+            raise NotImplementedError
+        return MapSummary(
+            game_map=self.map,
+            games_played=self.games_played + other.games_played,
+            total_duration=self.total_duration + other.total_duration,
+            red_wins=self.red_wins + other.red_wins,
+            blu_wins=self.blu_wins + other.blu_wins,
+            draws=self.draws + other.draws,
+            red_scores=self.red_scores + other.red_scores,
+            blu_scores=self.blu_scores + other.blu_scores,
+            red_steals=self.red_steals + other.red_steals,
+            blu_steals=self.blu_steals + other.blu_steals
+        )
+
+    @staticmethod
+    def record_game(game_map, game_date, duration, game_result: GameResult, red_scores, blu_scores, red_steals, blu_steals, cursor):
+        '''
+        Adds one game to its map's bucket for the day, called by Game.parse_and_store_game in the same transaction
+        '''
+        ROLLUP_UPSERT = '''
+            INSERT INTO MapDailyRollup (game_map, day, games_played, total_duration, red_wins, blu_wins, draws,
+                                        red_scores, blu_scores, red_steals, blu_steals)
+            VALUES (?, DATE(?), 1, ?, ?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT (game_map, day) DO UPDATE SET
+                games_played = games_played + 1,
+                total_duration = total_duration + excluded.total_duration,
+                red_wins = red_wins + excluded.red_wins,
+                blu_wins = blu_wins + excluded.blu_wins,
+                draws = draws + excluded.draws,
+                red_scores = red_scores + excluded.red_scores,
+                blu_scores = blu_scores + excluded.blu_scores,
+                red_steals = red_steals + excluded.red_steals,
+                blu_steals = blu_steals + excluded.blu_steals
+        '''
+        cursor.execute(ROLLUP_UPSERT, (game_map, game_date, duration,
+                                       game_result == GameResult.RED_VICTORY, game_result == GameResult.BLU_VICTORY, game_result == GameResult.DRAW,
+                                       red_scores, blu_scores, red_steals, blu_steals))
+
+    @staticmethod
+    def get_map_summary(game_map, date_from = None, date_to = None, cursor = None):
+        '''
+        date_from and date_to are inclusive days (YYYY-MM-DD), either can be None to leave that end open
+        '''
+        if cursor is None and SHARDS is not None:
+            return sum(SHARDS.map(lambda cursor: MapSummary.get_map_summary(game_map, date_from, date_to, cursor)), MapSummary(game_map))
+
+        if cursor is None:
+            connection = get_read_connection()
+            cursor = connection.cursor()
+            close_cursor = True
+        else:
+            close_cursor = False
+
+        try:
+            SUMMARY_QUERY = '''
+                SELECT COALESCE(SUM(games_played), 0), COALESCE(SUM(total_duration), 0), COALESCE(SUM(red_wins), 0),
+                       COALESCE(SUM(blu_wins), 0), COALESCE(SUM(draws), 0), COALESCE(SUM(red_scores), 0),
+                       COALESCE(SUM(blu_scores), 0), COALESCE(SUM(red_steals), 0), COALESCE(SUM(blu_steals), 0)
+                FROM MapDailyRollup
+                WHERE game_map = ? AND (? IS NULL OR day >= DATE(?)) AND (? IS NULL OR day <= DATE(?))
+            '''
+            cursor.execute(SUMMARY_QUERY, (game_map, date_from, date_from, date_to, date_to))
+            return MapSummary(game_map, *cursor.fetchone())
+        finally:
+            if close_cursor:
+                cursor.close()
+
+    # MapDailyRollup rows for every game with game_id between ? and ?
+    DAILY_BUCKETS_QUERY = '''
+        SELECT Game.game_map, DATE(Game.game_date), COUNT(*), SUM(Game.game_duration),
+               SUM(red.winner AND NOT blu.winner), SUM(blu.winner AND NOT red.winner), SUM(red.winner = blu.winner),
+               SUM((SELECT COUNT(*) FROM Score WHERE team_id = red.team_id)),
+               SUM((SELECT COUNT(*) FROM Score WHERE team_id = blu.team_id)),
+               SUM((SELECT COUNT(*) FROM Steal WHERE stealer_team_id = red.team_id)),
+               SUM((SELECT COUNT(*) FROM Steal WHERE stealer_team_id = blu.team_id))
+        FROM Game
+        JOIN Team AS red ON red.game_id = Game.game_id AND red.team_color = 'RED'
+        JOIN Team AS blu ON blu.game_id = Game.game_id AND blu.team_color = 'BLU'
+        WHERE Game.game_id BETWEEN ? AND ?
+        GROUP BY Game.game_map, DATE(Game.game_date)
+    '''
+
+    @staticmethod
+    def get_daily_buckets(first_game_id, last_game_id, cursor):
+        '''
+        Computes the MapDailyRollup rows for only the games in the id range, as a list of
+        (game_map, day, games_played, total_duration, red_wins, blu_wins, draws, red_scores, blu_scores, red_steals, blu_steals)
+        '''
+        cursor.execute(MapSummary.DAILY_BUCKETS_QUERY, (first_game_id, last_game_id))
+        return cursor.fetchall()
+
+    @staticmethod
+    def write_daily_buckets(buckets, cursor):
+        '''
+        Replaces every MapDailyRollup row with `buckets` (in the get_daily_buckets format). The caller commits
+        '''
+        cursor.execute("DELETE FROM MapDailyRollup")
+        ROLLUP_INSERT = '''
+            INSERT INTO MapDailyRollup (game_map, day, games_played, total_duration, red_wins, blu_wins, draws,
+                                        red_scores, blu_scores, red_steals, blu_steals)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        '''
+        cursor.executemany(ROLLUP_INSERT, buckets)
+
+    @staticmethod
+    def rebuild(cursor):
+        '''
+        Recomputes every MapDailyRollup bucket from the Game, Team, Score and Steal tables. The caller commits
+        '''
+        cursor.execute("DELETE FROM MapDailyRollup")
+        ROLLUP_REBUILD = '''
+            INSERT INTO MapDailyRollup (game_map, day, games_played, total_duration, red_wins, blu_wins, draws,
+                                        red_scores, blu_scores, red_steals, blu_steals)
+        ''' + MapSummary.DAILY_BUCKETS_QUERY
+        cursor.execute(ROLLUP_REBUILD, (0, 2**63 - 1))
+
     def serialize(self):
         return {
-            "id": self.id,
-            "date": self.date,
-            "duration": self.duration,
-            "map": self.map,
-            "blu_team": self.blu_team.serialize(),
-            "red_team": self.red_team.serialize(),
-            "game_result": self.game_result
+            'map': self.map,
+            'games_played': self.games_played,
+            'average_duration': self.average_duration,
+            'red_wins': self.red_wins,
+            'blu_wins': self.blu_wins,
+            'draws': self.draws,
+            'average_scores': self.average_scores,
+            'average_steals': self.average_steals,
+            'average_red_scores': self._per_game(self.red_scores),
+            'average_blu_scores': self._per_game(self.blu_scores),
+            'average_red_steals': self._per_game(self.red_steals),
+            'average_blu_steals': self._per_game(self.blu_steals)
         }
 
 
@@ -0,0 +1,168 @@
+'''
+Rebuilds derived data (currently the MapDailyRollup table) from the raw Game, Team and event tables.
+
+Games are split into game_id ranges and each range is computed in a separate process, with its own
+read-only connection. The partial results are merged and then written by this process alone, in one
+transaction. Finished ranges are saved to a checkpoint file, so running the same command again after an
+interruption skips them.
+
+    python rebuild.py                    # rebuild everything
+    python rebuild.py --range-size 2000 --workers 8
+    python rebuild.py --fresh            # ignore an existing checkpoint
+'''
+import argparse
+import json
+import os
+import sqlite3
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from myorm import DATABASE, SHARDS, MapSummary
+
+
+class MapDailyRollupBuilder():
+    '''
+    Partials are lists of MapDailyRollup rows, merged by adding up rows with the same (game_map, day)
+    '''
+    name = "map_daily_rollup"
+
+    @staticmethod
+    def compute(first_game_id, last_game_id, cursor):
+        return [list(row) for row in MapSummary.get_daily_buckets(first_game_id, last_game_id, cursor)]
+
+    @staticmethod
+    def merge(partials):
+        buckets = {}
+        for partial in partials:
+            for row in partial:
+                key = (row[0], row[1])
+                if key in buckets:
+                    buckets[key] = [total + value for total, value in zip(buckets[key], row[2:])]
+                else:
+                    buckets[key] = list(row[2:])
+        return [[game_map, day] + totals for (game_map, day), totals in buckets.items()]
+
+    @staticmethod
+    def write(merged, cursor):
+        MapSummary.write_daily_buckets(merged, cursor)
+
+
+BUILDERS = {builder.name: builder for builder in (MapDailyRollupBuilder,)}
+
+
+def _compute_range(database_path, first_game_id, last_game_id, builder_names):
+    '''
+    Runs in a worker process, returns (first_game_id, last_game_id, {builder name: partial})
+    '''
+    connection = sqlite3.connect(f"file:{database_path}?mode=ro", uri=True)
+    cursor = connection.cursor()
+    try:
+        return first_game_id, last_game_id, {name: BUILDERS[name].compute(first_game_id, last_game_id, cursor) for name in builder_names}
+    finally:
+        cursor.close()
+        connection.close()
+
+def _load_checkpoint(path):
+    if path is None or not os.path.exists(path):
+        return {}
+    with open(path) as checkpoint_file:
+        return json.load(checkpoint_file)
+
+def _save_checkpoint(path, checkpoint):
+    if path is None:
+        return
+    # Written to a temporary file first so an interruption can't leave half a checkpoint
+    with open(path + ".tmp", "w") as checkpoint_file:
+        json.dump(checkpoint, checkpoint_file)
+    os.replace(path + ".tmp", path)
+
+def _progress(message):
+    print(message, file=sys.stderr, flush=True)
+
+def rebuild_database(database_path, builder_names, range_size, workers, checkpoint, checkpoint_path):
+    '''
+    Rebuilds the derived data of one database file (the main database, or one shard)
+    '''
+    connection = sqlite3.connect(database_path)
+    first_game_id, last_game_id = connection.execute("SELECT MIN(game_id), MAX(game_id) FROM Game").fetchone()
+    connection.close()
+    if first_game_id is None:
+        first_game_id, last_game_id = 0, -1
+
+    state = checkpoint["databases"].setdefault(database_path, {"last_game_id": last_game_id, "range_size": range_size, "done": {}})
+    if state["range_size"] != range_size:
+        _progress(f"{database_path}: checkpoint used --range-size {state['range_size']}, continuing with that")
+        range_size = state["range_size"]
+    # Ranges stop at the max game_id seen by the first run, later games are picked up by the writer below
+    last_game_id = state["last_game_id"]
+
+    ranges = [(start, min(start + range_size - 1, last_game_id)) for start in range(first_game_id, last_game_id + 1, range_size)]
+    todo = [(start, end) for start, end in ranges if f"{start}-{end}" not in state["done"]]
+    _progress(f"{database_path}: {len(ranges)} ranges, {len(ranges) - len(todo)} already done")
+
+    started = time.monotonic()
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(_compute_range, database_path, start, end, builder_names) for start, end in todo]
+        for finished, future in enumerate(as_completed(futures), start=1):
+            start, end, partials = future.result()
+            state["done"][f"{start}-{end}"] = partials
+            _save_checkpoint(checkpoint_path, checkpoint)
+            elapsed = time.monotonic() - started
+            _progress(f"{database_path}: [{finished}/{len(todo)}] games {start}-{end} done, {elapsed:.1f}s elapsed")
+
+    # Single writer: BEGIN IMMEDIATE blocks ingest while the tables are replaced. Games stored since the
+    # rebuild started are computed here, inside the same transaction, so none are lost
+    connection = sqlite3.connect(database_path, isolation_level=None)
+    cursor = connection.cursor()
+    try:
+        cursor.execute("BEGIN IMMEDIATE")
+        for name in builder_names:
+            builder = BUILDERS[name]
+            partials = [range_partials[name] for range_partials in state["done"].values()]
+            partials.append(builder.compute(last_game_id + 1, 2**63 - 1, cursor))
+            builder.write(builder.merge(partials), cursor)
+        cursor.execute("COMMIT")
+    except Exception:
+        cursor.execute("ROLLBACK")
+        raise
+    finally:
+        cursor.close()
+        connection.close()
+    _progress(f"{database_path}: written")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--range-size", type=int, default=5000, help="games per worker task")
+    parser.add_argument("--workers", type=int, default=os.cpu_count(), help="worker processes")
+    parser.add_argument("--only", choices=list(BUILDERS), action="append", help="only rebuild this (can be repeated)")
+    parser.add_argument("--checkpoint", default="rebuild_checkpoint.json", help="checkpoint file, removed after a successful rebuild")
+    parser.add_argument("--fresh", action="store_true", help="ignore an existing checkpoint")
+    args = parser.parse_args()
+
+    builder_names = args.only or list(BUILDERS)
+    checkpoint = {} if args.fresh else _load_checkpoint(args.checkpoint)
+    if checkpoint.get("builders", builder_names) != builder_names:
+        parser.error(f"checkpoint {args.checkpoint} is for {checkpoint['builders']}, use --fresh to start over")
+    checkpoint["builders"] = builder_names
+    databases = checkpoint.setdefault("databases", {})
+
+    if SHARDS is None:
+        paths = [DATABASE]
+    else:
+        paths = [SHARDS.shard_path(shard) for shard in SHARDS.shards()]
+
+    for path in paths:
+        if databases.get(path, {}).get("written"):
+            _progress(f"{path}: already written")
+            continue
+        rebuild_database(path, builder_names, args.range_size, args.workers, checkpoint, args.checkpoint)
+        # Drop the partials once they're written, only the fact that this database is done matters now
+        databases[path] = {"written": True}
+        _save_checkpoint(args.checkpoint, checkpoint)
+
+    if os.path.exists(args.checkpoint):
+        os.remove(args.checkpoint)
+
+if __name__ == '__main__':
+    main()
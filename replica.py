@@ -0,0 +1,176 @@
+import fcntl
+import logging
+import os
+import sqlite3
+import threading
+import time
+from datetime import datetime, timezone
+
+
+class ReadReplica():
+    '''
+    A read-only copy of the primary database for stat queries, so long aggregate reads don't compete
+    with ingest for the primary file.
+
+    The copy is made with the sqlite3 online backup API, every refresh_interval seconds or once the primary
+    has refresh_after_games more games than the copy, whichever comes first (checked every check_interval
+    seconds). Staleness is measured against the primary's highest game_id, so games stored by other
+    processes count too.
+
+    With path=":memory:" the copy is kept in a shared-cache in-memory database. That's a full copy of the
+    database per server process (and for a moment two, while a refresh builds the next one), so with
+    several workers and a large database use a file path instead, which every process can share.
+
+    Each refresh builds a complete new copy and then swaps it in, so readers never see a half copied
+    database. Connections opened before a refresh keep reading the copy they opened.
+    '''
+    def __init__(self, primary_path, path=":memory:", refresh_interval=30, refresh_after_games=50, check_interval=1):
+        self.primary_path = primary_path
+        self.path = path
+        self.refresh_interval = refresh_interval
+        self.refresh_after_games = refresh_after_games
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._thread = None
+        self._generation = 0
+        self._uri = None
+        # Keeps the current in-memory copy alive while no reader has it open
+        self._keeper = None
+        self.refreshed_at = None
+        self.refresh_duration = None
+        self.refresh_count = 0
+        # Highest game_id in the copy
+        self.last_game_id = None
+
+    @property
+    def in_memory(self):
+        return self.path == ":memory:"
+
+    def refresh(self):
+        '''
+        Copies the primary into a new replica and swaps it in
+        '''
+        with self._refresh_lock:
+            started = time.monotonic()
+            source = sqlite3.connect(self.primary_path)
+            try:
+                if self.in_memory:
+                    self._generation += 1
+                    uri = f"file:passtime_replica_{id(self)}_{self._generation}?mode=memory&cache=shared"
+                    keeper = sqlite3.connect(uri, uri=True, check_same_thread=False)
+                    source.backup(keeper)
+                    last_game_id = ReadReplica._last_game_id(keeper)
+                    with self._lock:
+                        old_keeper, self._keeper, self._uri = self._keeper, keeper, uri
+                        # Closed under the lock, so connect() can't open the old uri once nothing keeps it alive
+                        # (that would make a new, empty database). Readers already using it keep it until they close
+                        if old_keeper is not None:
+                            old_keeper.close()
+                else:
+                    last_game_id = self._refresh_file(source)
+                    with self._lock:
+                        self._uri = f"file:{self.path}?mode=ro"
+            finally:
+                source.close()
+
+            with self._lock:
+                self.refreshed_at = time.time()
+                self.refresh_duration = time.monotonic() - started
+                self.refresh_count += 1
+                self.last_game_id = last_game_id
+
+    def _refresh_file(self, source):
+        '''
+        Copies the primary to self.path and returns the copy's highest game_id. Every worker process may share the
+        file, so they take turns through a lock file, and each builds its copy under its own temporary name
+        '''
+        waiting_since = time.time()
+        self._generation += 1
+        with open(self.path + ".lock", "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            # Another process swapped in a copy while this one waited, which has every game this one would copy
+            if os.path.exists(self.path) and os.path.getmtime(self.path) >= waiting_since:
+                copy = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True)
+                try:
+                    return ReadReplica._last_game_id(copy)
+                finally:
+                    copy.close()
+
+            temporary_path = f"{self.path}.{os.getpid()}.{self._generation}.tmp"
+            try:
+                destination = sqlite3.connect(temporary_path)
+                try:
+                    source.backup(destination)
+                    last_game_id = ReadReplica._last_game_id(destination)
+                finally:
+                    destination.close()
+                os.replace(temporary_path, self.path)
+            except Exception:
+                if os.path.exists(temporary_path):
+                    os.remove(temporary_path)
+                raise
+            return last_game_id
+
+    def connect(self):
+        '''
+        Opens a read-only connection to the current replica, making the first copy if there isn't one yet
+        '''
+        if self._uri is None:
+            self.refresh()
+        # Opened under the lock so refresh() can't drop this copy in between
+        with self._lock:
+            connection = sqlite3.connect(self._uri, uri=True, check_same_thread=False)
+        connection.execute("PRAGMA query_only = ON")
+        return connection
+
+    @staticmethod
+    def _last_game_id(connection):
+        return connection.execute("SELECT MAX(game_id) FROM Game").fetchone()[0] or 0
+
+    def games_behind(self):
+        '''
+        How many more games the primary has than the copy, or None before the first refresh
+        '''
+        if self.last_game_id is None:
+            return None
+        primary = sqlite3.connect(f"file:{self.primary_path}?mode=ro", uri=True)
+        try:
+            return max(ReadReplica._last_game_id(primary) - self.last_game_id, 0)
+        finally:
+            primary.close()
+
+    def _refresh_due(self):
+        if self.refreshed_at is None or time.time() - self.refreshed_at >= self.refresh_interval:
+            return True
+        return bool(self.refresh_after_games) and self.games_behind() >= self.refresh_after_games
+
+    def _run(self):
+        while True:
+            try:
+                if self._refresh_due():
+                    self.refresh()
+            except Exception:
+                # Keep serving the last good copy, the next interval tries again
+                logging.exception("Read replica refresh failed")
+            time.sleep(self.check_interval)
+
+    def start(self):
+        '''
+        Starts the background thread that refreshes the replica
+        '''
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="read-replica", daemon=True)
+            self._thread.start()
+
+    def serialize(self):
+        games_behind = self.games_behind()
+        with self._lock:
+            return {
+                'path': self.path,
+                'refreshed_at': datetime.fromtimestamp(self.refreshed_at, timezone.utc).isoformat() if self.refreshed_at else None,
+                'seconds_since_refresh': time.time() - self.refreshed_at if self.refreshed_at else None,
+                'games_behind': games_behind,
+                'last_refresh_duration': self.refresh_duration,
+                'refresh_count': self.refresh_count
+            }
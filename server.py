@@ -1,55 +1,147 @@
 from myorm import *
-from flask import Flask, request, jsonify
+from streaming import stream_json, JSON_MIMETYPE, NDJSON_MIMETYPE
+from distributions import DISTRIBUTIONS
+from events import TAILER, stream_events
+from flask import Flask, Response, request, jsonify
 
 app = Flask(__name__)
 
+Game.add_ingest_listener(DISTRIBUTIONS.record_game)
+TAILER.start()
+
+if REPLICA is not None:
+    REPLICA.start()
+
+@app.before_request
+def choose_read_database():
+    # Set on every request, a worker thread's context outlives the request that set it
+    READ_FROM_PRIMARY.set(request.endpoint in REPLICA_PRIMARY_ROUTES)
+
+def _csv_arg(name):
+    '''
+    Returns a comma separated query parameter as a list, or None if it wasn't given
+    '''
+    value = request.args.get(name, type=str)
+    if value is None:
+        return None
+    return [item.strip() for item in value.split(",") if item.strip()]
+
 @app.route('/game/<game_id>', methods=['GET'])
-def get_player_game_stats_endpoint(game_id):
+def get_game_endpoint(game_id):
     #game_id = request.args.get('game_id', type=int)
     steam_id = request.args.get('steam_id', type=int)
+    fields = _csv_arg('fields')
+    include = _csv_arg('include')
 
     game = Game.get_game(game_id)
 
-    return jsonify(game.serialize(), status=200)
+    return jsonify(game.serialize(fields, include)), 200
 
 @app.route('/game/<game_id>/player_stats', methods=['GET'])
-def get_player_game_stats_endpoint(game_id):
+def get_game_player_stats_endpoint(game_id):
     steam_id = request.args.get('steam_id', type=int)
 
     game = Game.get_game(game_id)
     # A player could be on both teams
-    blu_stats = PlayerTeamStats.get_player_team_stats(steam_id, game.blu_team.id)
-    red_stats = PlayerTeamStats.get_player_team_stats(steam_id, game.red_team.id)
+    blu_stats = game.blu_team.get_player_stats(steam_id)
+    red_stats = game.red_team.get_player_stats(steam_id)
 
     return jsonify((blu_stats+red_stats).serialize())
 
 @app.route('/game/<game_id>/team', methods=['GET'])
-def get_player_game_stats_endpoint(game_id):
+def get_game_team_endpoint(game_id):
     team = request.args.get('team', type=str)
+    fields = _csv_arg('fields')
+    include = _csv_arg('include')
 
     game = Game.get_game(game_id)
     # A player could be on both teams
     team = game.blu_team if team.upper() == "RED" else game.red_team
 
     # gets the team data and stats of each player
-    return jsonify(team.serialize())
+    return jsonify(team.serialize(include, fields))
 
 @app.route('/get_player_aggregate_stats', methods=['GET'])
 def get_player_aggregate_stats_endpoint():
     steam_id = request.args.get('steam_id', type=int)
 
     aggregate_stats = PlayerStats.get_player_total_stats(steam_id)
+    percentiles = DISTRIBUTIONS.serialize_percentiles(steam_id)
 
-    return jsonify(aggregate_stats.serialize(), status=200)
+    return jsonify(aggregate_stats.serialize() | {"percentiles": percentiles}), 200
 
-@app.route('/game/create', methods=['GET'])
-def get_player_aggregate_stats_endpoint():
-    steam_id = request.args.get('steam_id', type=int)
+@app.route('/distributions/<stat>', methods=['GET'])
+def get_distribution_endpoint(stat):
+    if stat not in DISTRIBUTIONS.STATS:
+        return jsonify({"error": f"unknown stat {stat}"}), 400
+
+    return jsonify(DISTRIBUTIONS.serialize_histogram(stat)), 200
+
+def _streaming_response(items, serialize=lambda item: item):
+    ndjson = request.args.get('format', type=str) == "ndjson"
+    return Response(stream_json(items, serialize, ndjson), mimetype=NDJSON_MIMETYPE if ndjson else JSON_MIMETYPE)
+
+@app.route('/games', methods=['GET'])
+def get_games_endpoint():
+    game_ids = [int(game_id) for game_id in _csv_arg('ids') or []]
+    fields = _csv_arg('fields')
+    include = _csv_arg('include')
+
+    return _streaming_response(Game.iter_games(game_ids), lambda game: game.serialize(fields, include))
+
+@app.route('/player/<steam_id>/games', methods=['GET'])
+def get_player_games_endpoint(steam_id):
+    fields = _csv_arg('fields')
+    include = _csv_arg('include')
+    game_ids = Game.iter_player_game_ids(int(steam_id))
+
+    return _streaming_response(Game.iter_games(game_ids), lambda game: game.serialize(fields, include))
+
+@app.route('/leaderboard/<stat>', methods=['GET'])
+def get_leaderboard_endpoint(stat):
+    if stat not in PlayerStats.LEADERBOARD_QUERIES:
+        return jsonify({"error": f"unknown stat {stat}"}), 400
+
+    rows = PlayerStats.iter_leaderboard(stat)
+
+    return _streaming_response(rows, lambda row: {"steam_id": row[0], stat: row[1]})
+
+@app.route('/maps/<game_map>/summary', methods=['GET'])
+def get_map_summary_endpoint(game_map):
+    date_from = request.args.get('from', type=str)
+    date_to = request.args.get('to', type=str)
+
+    summary = MapSummary.get_map_summary(game_map, date_from, date_to)
+
+    return jsonify(summary.serialize()), 200
+
+@app.route('/events/stream', methods=['GET'])
+def events_stream_endpoint():
+    steam_ids = {int(steam_id) for steam_id in _csv_arg('steam_id') or []}
+    maps = set(_csv_arg('map') or [])
+
+    # X-Accel-Buffering stops nginx from holding the events back
+    return Response(stream_events(steam_ids, maps), mimetype="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+@app.route('/replica/status', methods=['GET'])
+def replica_status_endpoint():
+    if REPLICA is None:
+        return jsonify({"enabled": False}), 200
+
+    return jsonify({"enabled": True} | REPLICA.serialize()), 200
+
+@app.route('/game/create', methods=['POST'])
+def create_game_endpoint():
+    game_id = Game.parse_and_store_game(request.get_json())
+
+    return jsonify({"id": game_id}), 200
 
-    game = Game.parse_and_store_game()
+@app.route('/game/create_bulk', methods=['POST'])
+def create_games_endpoint():
+    game_ids = Game.parse_and_store_games(request.get_json())
 
-    # TODO
-    return jsonify("", status=200)
+    return jsonify({"ids": game_ids}), 200
 
 if __name__ == '__main__':
     app.run(debug=True)
\ No newline at end of file
@@ -0,0 +1,229 @@
+import os
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+
+
+class ShardNotFoundError(Exception):
+    '''
+    Raised when a game_id isn't in the shard catalog
+    '''
+
+
+class ShardRouter():
+    '''
+    Splits games across one SQLite file per month (partition="month") or per season (partition="season",
+    seasons run by calendar quarter). A catalog database in the same directory hands out game ids and
+    records which shard each game is in.
+
+    New shards get the schema of the template database (the normal database_path).
+    Shards whose period ended more than readonly_after_days ago are opened read-only for reads,
+    and every read connection is memory-mapped with mmap_size.
+    '''
+    PARTITIONS = ("month", "season")
+
+    def __init__(self, template_path, directory, partition="month", readonly_after_days=31, mmap_size=256 * 1024 * 1024, max_workers=4):
+        if partition not in ShardRouter.PARTITIONS:
+            raise ValueError(f"Unknown shard partition: {partition}")
+        self.template_path = template_path
+        self.directory = directory
+        self.partition = partition
+        self.readonly_after_days = readonly_after_days
+        self.mmap_size = mmap_size
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="shard")
+        self._create_lock = threading.Lock()
+
+        os.makedirs(directory, exist_ok=True)
+        self.catalog_path = os.path.join(directory, "catalog.db")
+        connection = sqlite3.connect(self.catalog_path)
+        with connection:
+            connection.execute("CREATE TABLE IF NOT EXISTS Shard (shard TEXT PRIMARY KEY, path TEXT)")
+            connection.execute("CREATE TABLE IF NOT EXISTS ShardGame (game_id INTEGER PRIMARY KEY AUTOINCREMENT, shard TEXT, content_hash TEXT UNIQUE)")
+        connection.close()
+
+    def shard_for_date(self, game_date):
+        '''
+        Returns the name of the shard a game played at game_date (ISO 8601 string) belongs to
+        '''
+        day = datetime.fromisoformat(game_date.replace("Z", "+00:00")).date()
+        if self.partition == "month":
+            return f"{day.year:04d}-{day.month:02d}"
+        return f"{day.year:04d}-S{(day.month - 1) // 3 + 1}"
+
+    def _period_end(self, shard):
+        year, period = shard.split("-")
+        if self.partition == "month":
+            month = int(period)
+        else:
+            month = int(period[1:]) * 3
+        if month == 12:
+            return date(int(year), 12, 31)
+        return date(int(year), month + 1, 1) - timedelta(days=1)
+
+    def is_readonly(self, shard):
+        return date.today() - self._period_end(shard) > timedelta(days=self.readonly_after_days)
+
+    def shard_path(self, shard):
+        return os.path.join(self.directory, f"{shard}.db")
+
+    def _catalog(self):
+        return sqlite3.connect(self.catalog_path)
+
+    def shards(self):
+        '''
+        All shard names, oldest first
+        '''
+        connection = self._catalog()
+        try:
+            return [row[0] for row in connection.execute("SELECT shard FROM Shard ORDER BY shard")]
+        finally:
+            connection.close()
+
+    def allocate_game_id(self, game_date):
+        '''
+        Reserves a new game_id in the catalog, returns (game_id, shard)
+        '''
+        shard = self.shard_for_date(game_date)
+        connection = self._catalog()
+        try:
+            with connection:
+                connection.execute("INSERT OR IGNORE INTO Shard (shard, path) VALUES (?, ?)", (shard, self.shard_path(shard)))
+                cursor = connection.execute("INSERT INTO ShardGame (shard) VALUES (?)", (shard,))
+                return cursor.lastrowid, shard
+        finally:
+            connection.close()
+
+    def confirm_game(self, game_id, content_hash):
+        '''
+        Records the content_hash of a game once it's committed to its shard, so find_games only ever returns stored games
+        '''
+        connection = self._catalog()
+        try:
+            with connection:
+                connection.execute("UPDATE OR IGNORE ShardGame SET content_hash = ? WHERE game_id = ?", (content_hash, game_id))
+        finally:
+            connection.close()
+
+    def find_games(self, content_hashes):
+        '''
+        Returns {content_hash: game_id} of the stored games with these hashes, 500 hashes per query
+        '''
+        found = {}
+        content_hashes = list(set(content_hashes))
+        connection = self._catalog()
+        try:
+            for i in range(0, len(content_hashes), 500):
+                batch = content_hashes[i:i + 500]
+                found.update(connection.execute(f"SELECT content_hash, game_id FROM ShardGame WHERE content_hash IN ({','.join('?' * len(batch))})", batch))
+            return found
+        finally:
+            connection.close()
+
+    def shards_after(self, game_id):
+        '''
+        Names of the shards that have game ids above game_id
+        '''
+        connection = self._catalog()
+        try:
+            return [row[0] for row in connection.execute("SELECT DISTINCT shard FROM ShardGame WHERE game_id > ? ORDER BY shard", (game_id,))]
+        finally:
+            connection.close()
+
+    def last_game_id(self):
+        '''
+        The highest game_id handed out, 0 if there are none
+        '''
+        connection = self._catalog()
+        try:
+            return connection.execute("SELECT MAX(game_id) FROM ShardGame").fetchone()[0] or 0
+        finally:
+            connection.close()
+
+    def release_game_id(self, game_id):
+        '''
+        Removes a game_id reserved by allocate_game_id whose game was never stored
+        '''
+        connection = self._catalog()
+        try:
+            with connection:
+                connection.execute("DELETE FROM ShardGame WHERE game_id = ?", (game_id,))
+        finally:
+            connection.close()
+
+    def shard_for_game(self, game_id):
+        connection = self._catalog()
+        try:
+            res = connection.execute("SELECT shard FROM ShardGame WHERE game_id = ?", (game_id,)).fetchone()
+        finally:
+            connection.close()
+        if res is None:
+            raise ShardNotFoundError(game_id)
+        return res[0]
+
+    def _create_shard(self, path):
+        '''
+        Creates a shard with the template's schema, unless another thread or process gets there first
+        '''
+        with self._create_lock:
+            if os.path.exists(path):
+                return
+            template = sqlite3.connect(self.template_path)
+            try:
+                schema = [row[0] for row in template.execute("SELECT sql FROM sqlite_master WHERE sql IS NOT NULL AND name NOT LIKE 'sqlite_%'")]
+            finally:
+                template.close()
+            # Built under a temporary name and linked into place, so nobody opens a shard without its tables.
+            # Unlike os.replace, os.link fails if another process already created the shard
+            temporary_path = f"{path}.{os.getpid()}.tmp"
+            connection = sqlite3.connect(temporary_path)
+            with connection:
+                for statement in schema:
+                    connection.execute(statement)
+            connection.close()
+            try:
+                os.link(temporary_path, path)
+            except FileExistsError:
+                pass
+            finally:
+                os.remove(temporary_path)
+
+    def connect(self, shard, write=False):
+        '''
+        Opens a connection to a shard. Connections aren't tied to the thread that opened them,
+        since generator queries can be resumed on a different thread
+        '''
+        path = self.shard_path(shard)
+        if not os.path.exists(path):
+            self._create_shard(path)
+
+        if write:
+            return sqlite3.connect(path, check_same_thread=False)
+
+        if self.is_readonly(shard):
+            connection = sqlite3.connect(f"file:{path}?mode=ro", uri=True, check_same_thread=False)
+        else:
+            connection = sqlite3.connect(path, check_same_thread=False)
+        connection.execute(f"PRAGMA mmap_size = {int(self.mmap_size)}")
+        return connection
+
+    def connect_for_game(self, game_id):
+        return self.connect(self.shard_for_game(game_id))
+
+    def _run_on_shard(self, shard, func):
+        connection = self.connect(shard)
+        cursor = connection.cursor()
+        try:
+            return func(cursor)
+        finally:
+            cursor.close()
+            connection.close()
+
+    def map(self, func, shards=None):
+        '''
+        Calls func(cursor) once per shard in parallel and returns the results in shard order
+        '''
+        if shards is None:
+            shards = self.shards()
+        futures = [self._executor.submit(self._run_on_shard, shard, func) for shard in shards]
+        return [future.result() for future in futures]
@@ -0,0 +1,44 @@
+import json
+
+JSON_MIMETYPE = "application/json"
+NDJSON_MIMETYPE = "application/x-ndjson"
+
+# Items are buffered into chunks of about this many characters before being yielded
+CHUNK_SIZE = 16 * 1024
+
+def _buffered(pieces, chunk_size=CHUNK_SIZE):
+    buffer = []
+    size = 0
+    for piece in pieces:
+        buffer.append(piece)
+        size += len(piece)
+        if size >= chunk_size:
+            yield "".join(buffer)
+            buffer = []
+            size = 0
+    if buffer:
+        yield "".join(buffer)
+
+def _json_array_pieces(items, serialize):
+    yield "["
+    first = True
+    for item in items:
+        if not first:
+            yield ","
+        first = False
+        yield json.dumps(serialize(item))
+    yield "]"
+
+def _ndjson_pieces(items, serialize):
+    for item in items:
+        yield json.dumps(serialize(item))
+        yield "\n"
+
+def stream_json(items, serialize=lambda item: item, ndjson=False):
+    '''
+    Yields `items` as JSON text chunks, either one JSON array or (with ndjson=True) one JSON document per line.
+    Only one chunk is held in memory at a time, so `items` should be a generator (e.g. from iter_rows)
+    '''
+    if ndjson:
+        return _buffered(_ndjson_pieces(items, serialize))
+    return _buffered(_json_array_pieces(items, serialize))
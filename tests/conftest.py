@@ -0,0 +1,42 @@
+import copy
+import subprocess
+import sys
+from pathlib import Path
+
+import pytest
+
+import myorm
+
+ROOT = Path(__file__).resolve().parent.parent
+
+GAME = {
+    "date": "2024-01-01T12:00:00.000Z",
+    "duration": 600,
+    "map": "pass_arena",
+    "game_result": "BLU",
+    "blu_team": {"name": "blu", "players": [{"steam_id": "76561198000000001", "alias": "one"}]},
+    "red_team": {"name": "red", "players": [{"steam_id": "76561198000000002", "alias": "two"}]},
+    "scores": [{"game_time": 10, "scorer": "76561198000000001", "team": "BLU"}],
+    "steals": [{"game_time": 20, "victim": "76561198000000002", "victim_team": "RED",
+                "stealer": "76561198000000001", "stealer_team": "BLU"}],
+    "passes": []
+}
+
+
+@pytest.fixture
+def database(tmp_path, monkeypatch):
+    '''
+    Points myorm at a new, empty database made by db/createDatabase.py and returns its path
+    '''
+    subprocess.run([sys.executable, str(ROOT / "db" / "createDatabase.py")], cwd=tmp_path, check=True, capture_output=True)
+    path = str(tmp_path / "passtime_stats.db")
+    monkeypatch.setattr(myorm, "DATABASE", path)
+    return path
+
+
+@pytest.fixture
+def game():
+    '''
+    A small game in insert_game_schema.json format
+    '''
+    return copy.deepcopy(GAME)
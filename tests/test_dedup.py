@@ -0,0 +1,44 @@
+from myorm import Game, get_db_connection
+
+
+def game_count():
+    connection = get_db_connection()
+    try:
+        return connection.execute("SELECT COUNT(*) FROM Game").fetchone()[0]
+    finally:
+        connection.close()
+
+
+def test_duplicate_upload_returns_existing_id(database, game):
+    game_id = Game.parse_and_store_game(game)
+    assert Game.parse_and_store_game(game) == game_id
+    assert game_count() == 1
+
+
+def test_bulk_returns_existing_and_in_batch_duplicate_ids(database, game):
+    existing_id = Game.parse_and_store_game(game)
+    new_game = dict(game, date="2024-01-02T12:00:00.000Z")
+
+    game_ids = Game.parse_and_store_games([new_game, game, new_game])
+
+    assert game_ids[1] == existing_id
+    assert game_ids[0] == game_ids[2] != existing_id
+    assert game_count() == 2
+
+
+def test_bulk_retries_after_concurrent_store(database, game, monkeypatch):
+    new_game = dict(game, date="2024-01-02T12:00:00.000Z")
+    # Stored by "another request" after the bulk upload looked the hashes up
+    existing_id = Game.parse_and_store_game(game)
+    find_games_by_hash = Game.find_games_by_hash
+    lookups = []
+    def stale_first_lookup(content_hashes, cursor):
+        lookups.append(content_hashes)
+        return {} if len(lookups) == 1 else find_games_by_hash(content_hashes, cursor)
+    monkeypatch.setattr(Game, "find_games_by_hash", staticmethod(stale_first_lookup))
+
+    game_ids = Game.parse_and_store_games([new_game, game])
+
+    assert len(lookups) == 2
+    assert game_ids[1] == existing_id
+    assert game_count() == 2
@@ -0,0 +1,23 @@
+import pytest
+
+from events import GameEventBroadcaster, GameTailer
+from myorm import Game
+
+
+@pytest.mark.parametrize("lookback", [0, 100])
+def test_tailer_publishes_only_new_games(database, game, lookback):
+    for day in range(1, 4):
+        Game.parse_and_store_game(dict(game, date=f"2024-01-0{day}T12:00:00.000Z"))
+    published = []
+    broadcaster = GameEventBroadcaster()
+    broadcaster.publish = published.append
+    tailer = GameTailer(broadcaster)
+    # The lookback is only used with sharding, but the tailer handles it the same way on one database
+    tailer.lookback = lookback
+
+    tailer.poll()
+    game_id = Game.parse_and_store_game(dict(game, date="2024-01-05T12:00:00.000Z"))
+    tailer.poll()
+    tailer.poll()
+
+    assert [notice["game_id"] for notice in published] == [game_id]
@@ -0,0 +1,33 @@
+import pytest
+
+import myorm
+from myorm import Game
+
+
+@pytest.fixture
+def statements(database, game, monkeypatch):
+    '''
+    Stores the test game and returns (game_id, list of executed statements)
+    '''
+    game_id = Game.parse_and_store_game(game)
+
+    executed = []
+    get_db_connection = myorm.get_db_connection
+    def traced_connection(check_same_thread=True):
+        connection = get_db_connection(check_same_thread)
+        connection.set_trace_callback(executed.append)
+        return connection
+    monkeypatch.setattr(myorm, "get_db_connection", traced_connection)
+    return game_id, executed
+
+
+@pytest.mark.parametrize("fields, include, expected", [
+    (None, None, 26),
+    (["date", "map", "game_result"], None, 2),
+    (["blu_team"], ["players"], 3),
+    (["blu_team", "scores"], ["team_stats"], 4),
+])
+def test_projection_statement_count(statements, fields, include, expected):
+    game_id, executed = statements
+    Game.get_game(game_id).serialize(fields, include)
+    assert len(executed) == expected, executed
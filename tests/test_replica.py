@@ -0,0 +1,32 @@
+import threading
+
+from myorm import Game
+from replica import ReadReplica
+
+
+def test_replicas_sharing_a_file(database, game, tmp_path):
+    Game.parse_and_store_game(game)
+    path = str(tmp_path / "replica.db")
+    errors = []
+
+    def refresh_loop():
+        replica = ReadReplica(database, path=path)
+        for _ in range(20):
+            try:
+                replica.refresh()
+                connection = replica.connect()
+                try:
+                    assert connection.execute("SELECT COUNT(*) FROM Game").fetchone()[0] == 1
+                finally:
+                    connection.close()
+            except Exception as error:
+                errors.append(error)
+
+    threads = [threading.Thread(target=refresh_loop) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    assert not list(tmp_path.glob("replica.db.*.tmp"))